@@ -3,10 +3,11 @@ __version__ = '0.1.0'
 from . generate import Generate
 from . sort import Sort
 from . correct import Correct
+from . pipeline import Pipeline
 from . mark import Mark
 from . moodle_converter import MoodleConverter
 from . markdown_converter import MarkdownConverter
 from . update_corrected import UpdateCorrected
 #from . gui.__main__ import main_ui
 
-__all__ = ['Generate', 'Sort', 'Correct', 'Mark', 'MoodleConverter', 'MarkdownConverter', 'UpdateCorrected'] #, 'main_ui']
\ No newline at end of file
+__all__ = ['Generate', 'Sort', 'Correct', 'Pipeline', 'Mark', 'MoodleConverter', 'MarkdownConverter', 'UpdateCorrected'] #, 'main_ui']
\ No newline at end of file
@@ -13,7 +13,7 @@ import click
 from datetime import datetime as dt
 import dateparser as dp
 import yaml
-from omrexams import Generate, Sort, Correct, Mark, MoodleConverter, UpdateCorrected, MarkdownConverter, __version__ #, main_ui
+from omrexams import Generate, Sort, Correct, Pipeline, Mark, MoodleConverter, UpdateCorrected, MarkdownConverter, __version__ #, main_ui
 import pandas as pd
 import re
 import logging
@@ -23,6 +23,7 @@ import math
 from tinydb import TinyDB, Query, where
 import json
 from .mark import custom_correction
+from .sort import MANIFEST_NAME
 import numpy as np
 from tabulate import tabulate
 
@@ -77,6 +78,48 @@ class OptionRequiredIf(click.Option):
 
 DATETIME = Datetime()
 
+class Detectors(click.ParamType):
+    '''
+    A comma separated list of circle detectors, in the order they are run.
+    '''
+
+    name = 'detectors'
+
+    def convert(self, value, param, ctx):
+        if value is None:
+            return value
+
+        if isinstance(value, list):
+            value = ','.join(value)
+
+        detectors = [d.strip().lower() for d in value.split(',') if d.strip()]
+        unknown = [d for d in detectors if d not in Correct.DETECTORS]
+        if unknown:
+            self.fail(f'Unknown circle detectors {", ".join(unknown)}, they should be among {", ".join(Correct.DETECTORS)}', param, ctx)
+        return detectors
+
+DETECTORS = Detectors()
+
+def configured_detectors(config_file):
+    '''
+    The circle detectors of the correction section of the config file, if any
+    '''
+    if not os.path.exists(config_file):
+        return None
+    with open(config_file, 'r') as f:
+        config = yaml.load(f, Loader=yaml.Loader) or {}
+    return DETECTORS.convert(config.get('correction', {}).get('detectors'), None, None)
+
+def check_outputs(per_student, index, combined):
+    '''
+    Exits if the output options would leave nothing written, or be ignored, before any work starts
+    '''
+    if not per_student:
+        for given, option in ((not combined, '--no-combined'), (index, '--index')):
+            if given:
+                click.secho(f"{option} requires --per-student", fg='red')
+                sys.exit(1)
+
 @click.group()
 @click.version_option(version=__version__)
 @click.option('--debug/--no-debug', default=False)
@@ -269,21 +312,32 @@ def test(ctx, config, questions_dir, output, yes):
 @click.option('--datafile', '-d', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=True), required=False)
 @click.option('--resolution', '-r', default=300)
 @click.option('--paper', '-p', type=click.Choice(['A4', 'A3'], case_sensitive=False), default='A4', required=False)
+@click.option('--container', type=click.Choice(['png', 'raw'], case_sensitive=False), required=False, 
+    help='Store the sorted pages into a single container file with the given codec (fast png or raw memory-mappable) instead of one png file per page')
+@click.option('--preview-resolution', type=int, required=False, 
+    help='Decode the qrcodes at this lower resolution, only the pages with an exam are then rasterized at full resolution')
+@click.option('--clean/--no-clean', default=False, 
+    help='Remove the content of the sorted directory instead of sorting only the pages not already processed by a previous run')
 @click.option('--yes', '-y', is_flag=True, type=bool, required=False, default=False, help='Answer yes to all prompt requests')
 @click.pass_context
-def sort(ctx, scanned, sorted_dir, datafile, resolution, paper, yes):
+def sort(ctx, scanned, sorted_dir, datafile, resolution, paper, container, preview_resolution, clean, yes):
     """
     Sorts a set of pdf scanned documents into a series of png images, one for each sheet.
+    Pages already sorted by a previous run on the same directory are skipped, unless --clean is given
+    (a directory without the manifest of a previous run is overwritten, after confirmation).
     """
-    if os.path.exists(sorted_dir):
+    # without a manifest the content of the directory (e.g., of a previous session or of another exam) 
+    # cannot be resumed, so it is overwritten as well
+    resumable = os.path.exists(os.path.join(sorted_dir, MANIFEST_NAME))
+    if os.path.exists(sorted_dir) and os.listdir(sorted_dir) and (clean or not resumable):
         if yes or click.confirm(f"Sorted directory {sorted_dir} exists, overwrite its content?", default=True):
-            pass
+            clean = True
         else:
             click.secho("Nothing done", fg='bright_yellow')
             sys.exit(0)
 
-    sorter = Sort(scanned, sorted_dir, datafile)
-    sorter.sort(resolution, paper.upper())
+    sorter = Sort(scanned, sorted_dir, datafile, container=container.lower() if container else None)
+    sorter.sort(resolution, paper.upper(), clean, preview_resolution)
 
 
 @cli.command()
@@ -292,23 +346,135 @@ def sort(ctx, scanned, sorted_dir, datafile, resolution, paper, yes):
 @click.option('--datafile', '-d', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=True, writable=True), required=True)
 @click.option('--resolution', '-r', default=300)
 @click.option('--compression', '-z', type=int, default=50)
+@click.option('--threads', '-t', type=click.IntRange(1, len(Correct.DETECTORS)), required=False, 
+    help='Number of threads running the circle detectors of each page (by default balanced against the number of worker processes)')
 @click.option('--yes', '-y', is_flag=True, type=bool, required=False, default=False, help='Answer yes to all prompt requests')
+@click.option('--template/--no-template', default=True, 
+    help='Read the answers at the bubble positions predicted from the qrcode first, running the circle detectors only on the rows that are not clear')
+@click.option('--agreement', type=click.IntRange(0, len(Correct.DETECTORS)), default=2, 
+    help='Number of circle detectors that must agree on every question before stopping the detector cascade (0 for running all of them)')
+@click.option('--detectors', type=DETECTORS, required=False, 
+    help=f'Comma separated circle detectors to be run, in order, among {", ".join(Correct.DETECTORS)} (by default those in the correction section of the config file or {",".join(Correct.DEFAULT_DETECTORS)})')
+@click.option('--config', type=click.Path(exists=False, resolve_path=True), default=os.path.join('.', 'config.yaml'))
+@click.option('--headless', is_flag=True, default=False, 
+    help='Record the annotations of the corrected pages instead of drawing them, only the pages deserving attention are collected into the corrected pdf file (the others can be rendered by the render command)')
+@click.option('--per-student', type=click.Path(exists=False, file_okay=False, resolve_path=True), required=False, 
+    help='Directory where to write the corrected pdf file of each student (named after the student_id)')
+@click.option('--index', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=True), required=False, 
+    help='Csv file mapping each student to the corrected pdf file written in the per-student directory')
+@click.option('--combined/--no-combined', default=True, help='Collect all the corrected pages into the corrected pdf file')
 @click.pass_context
-def correct(ctx, sorted_dir, corrected, datafile, resolution, compression, yes):  
+def correct(ctx, sorted_dir, corrected, datafile, resolution, compression, threads, template, agreement, detectors, config, headless, per_student, index, combined, yes):  
     """
     Corrects a set of pages creating a (compressed) corrected pdf file and storing the correction data into a .json file
     """
 
-    if os.path.exists(corrected):
+    if headless and per_student:
+        # a headless correction renders only the pages deserving attention, the files of the students would be incomplete
+        click.secho("The --per-student option cannot be used with --headless, the pdf files of the students can be written afterwards by the render command with --per-student", fg='red')
+        sys.exit(1)
+    check_outputs(per_student, index, combined)
+    if combined and os.path.exists(corrected):
         if yes or click.confirm(f"Corrected file {corrected} exists, overwrite its content?", default=True):
             pass
         else:
             click.secho("Nothing done", fg='bright_yellow')
             sys.exit(0)
 
-    corrector = Correct(sorted_dir, corrected, datafile, resolution, compression)
+    corrector = Correct(sorted_dir, corrected, datafile, resolution, compression, threads=threads, template=template, agreement=agreement,
+                        detectors=detectors or configured_detectors(config), headless=headless, per_student=per_student, combined=combined, index=index)
     corrector.correct()
 
+@cli.command()
+@click.argument('sorted_dir', type=click.Path(exists=True, file_okay=False, resolve_path=True), default='sorted')
+@click.option('--corrected', '-c', type=click.Path(exists=False, file_okay=True, resolve_path=True), default=os.path.join('.', 'corrected-exam.pdf'))
+@click.option('--resolution', '-r', default=300)
+@click.option('--compression', '-z', type=int, default=50)
+@click.option('--student', '-s', multiple=True, help='Render only the pages of this student (it can be repeated)')
+@click.option('--yes', '-y', is_flag=True, type=bool, required=False, default=False, help='Answer yes to all prompt requests')
+@click.option('--per-student', type=click.Path(exists=False, file_okay=False, resolve_path=True), required=False, 
+    help='Directory where to write the corrected pdf file of each student (named after the student_id)')
+@click.option('--index', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=True), required=False, 
+    help='Csv file mapping each student to the corrected pdf file written in the per-student directory')
+@click.option('--combined/--no-combined', default=True, help='Collect all the corrected pages into the corrected pdf file')
+@click.pass_context
+def render(ctx, sorted_dir, corrected, resolution, compression, student, per_student, index, combined, yes):
+    """
+    Renders the corrected pages recorded by a headless correction into the corrected pdf file
+    """
+    check_outputs(per_student, index, combined)
+    annotations = Correct.annotations_filename(corrected)
+    if not os.path.exists(annotations):
+        click.secho(f"Annotations file {annotations} not found, the correction should be run with the --headless option", fg='red')
+        sys.exit(1)
+    if combined and os.path.exists(corrected):
+        if yes or click.confirm(f"Corrected file {corrected} exists, overwrite its content?", default=True):
+            pass
+        else:
+            click.secho("Nothing done", fg='bright_yellow')
+            sys.exit(0)
+
+    corrector = Correct(sorted_dir, corrected, None, resolution, compression, per_student=per_student, combined=combined, index=index)
+    corrector.render(student)
+
+@cli.command()
+@click.argument('scanned', type=click.Path(exists=True, file_okay=True, dir_okay=True, resolve_path=True),  nargs=-1, required=True)
+@click.option('--corrected', '-c', type=click.Path(exists=False, file_okay=True, resolve_path=True), default=os.path.join('.', 'corrected-exam.pdf'))
+@click.option('--datafile', '-d', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=True, writable=True), required=True)
+@click.option('--resolution', '-r', default=300)
+@click.option('--compression', '-z', type=int, default=50)
+@click.option('--paper', '-p', type=click.Choice(['A4', 'A3'], case_sensitive=False), default='A4', required=False)
+@click.option('--preview-resolution', type=int, required=False, 
+    help='Decode the qrcodes at this lower resolution, only the pages with an exam are then rasterized at full resolution')
+@click.option('--threads', '-t', type=click.IntRange(1, len(Correct.DETECTORS)), required=False, 
+    help='Number of threads running the circle detectors of each page (by default balanced against the number of worker processes)')
+@click.option('--yes', '-y', is_flag=True, type=bool, required=False, default=False, help='Answer yes to all prompt requests')
+@click.option('--template/--no-template', default=True, 
+    help='Read the answers at the bubble positions predicted from the qrcode first, running the circle detectors only on the rows that are not clear')
+@click.option('--agreement', type=click.IntRange(0, len(Correct.DETECTORS)), default=2, 
+    help='Number of circle detectors that must agree on every question before stopping the detector cascade (0 for running all of them)')
+@click.option('--detectors', type=DETECTORS, required=False, 
+    help=f'Comma separated circle detectors to be run, in order, among {", ".join(Correct.DETECTORS)} (by default those in the correction section of the config file or {",".join(Correct.DEFAULT_DETECTORS)})')
+@click.option('--config', type=click.Path(exists=False, resolve_path=True), default=os.path.join('.', 'config.yaml'))
+@click.option('--per-student', type=click.Path(exists=False, file_okay=False, resolve_path=True), required=False, 
+    help='Directory where to write the corrected pdf file of each student (named after the student_id)')
+@click.option('--index', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=True), required=False, 
+    help='Csv file mapping each student to the corrected pdf file written in the per-student directory')
+@click.option('--combined/--no-combined', default=True, help='Collect all the corrected pages into the corrected pdf file')
+@click.pass_context
+def process(ctx, scanned, corrected, datafile, resolution, compression, paper, preview_resolution, threads, template, agreement, detectors, config, per_student, index, combined, yes):
+    """
+    Sorts and corrects a set of pdf scanned documents in a single pass, without storing the sorted pages
+    """
+    check_outputs(per_student, index, combined)
+    if combined and os.path.exists(corrected):
+        if yes or click.confirm(f"Corrected file {corrected} exists, overwrite its content?", default=True):
+            pass
+        else:
+            click.secho("Nothing done", fg='bright_yellow')
+            sys.exit(0)
+
+    pipeline = Pipeline(scanned, corrected, datafile, resolution, compression, paper.upper(), preview=preview_resolution, 
+                        threads=threads, template=template, agreement=agreement, detectors=detectors or configured_detectors(config),
+                        per_student=per_student, combined=combined, index=index)
+    pipeline.process()
+
+@cli.command()
+@click.option('--pages', '-n', type=int, default=5, help='Number of synthetic pages for each degradation level')
+@click.option('--resolution', '-r', default=300)
+@click.option('--seed', '-s', type=int, default=0)
+@click.option('--output', '-o', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=True), default='qrbenchmark.json')
+@click.pass_context
+def benchmark_qr(ctx, pages, resolution, seed, output):
+    """
+    Benchmarks the qrcode decoding libraries and preprocessing stages on synthetic (degraded) pages, saving the results as json
+    """
+    from .utils import qrbenchmark
+    results = qrbenchmark.run(pages, resolution, seed)
+    click.echo(qrbenchmark.table(results))
+    qrbenchmark.save(results, output, pages=pages, resolution=resolution, seed=seed)
+    click.secho(f"Results saved in {output}", fg='green')
+
 @cli.command()
 @click.argument('datafile', type=click.Path(exists=True, file_okay=True, dir_okay=False, resolve_path=True, writable=True), required=True)
 @click.option('--output', '-o', type=click.Path(exists=False, file_okay=True, dir_okay=False, resolve_path=True, writable=True), required=True)
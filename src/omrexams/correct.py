@@ -1,27 +1,34 @@
 import cv2
 import numpy as np
 from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import re
-import io
+import json
 import math
 from skimage.feature import peak_local_max
 import click
 from . utils import qrdecoder
+from . utils.page_store import PageStore, CONTAINER_NAME, load_metadata
 import multiprocessing as mp
 import glob
 import pandas as pd
 import os
 from . utils.colors import *
+from . utils.image_utils import RoiPreprocessing
+from . utils.overlay import Overlay
 import logging
 from collections import Counter
 from itertools import combinations
-import img2pdf
-from pypdf import PdfReader, PdfWriter
+from . utils.pdf_writer import StreamingPdfWriter
 from tinydb import TinyDB, Query
 from shutil import copy2, rmtree
 import tempfile
 import inflect
 import traceback
+import time
+from tabulate import tabulate
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger("omrexams")
 
@@ -34,53 +41,187 @@ def decode_answers(answers, permutation):
         res.append(c in answers)
     return list(bool(a) for a in np.array(res)[permutation])
 
+def schedule(pages=None, threads=None, cpu=None, detectors=None):
+    """
+    Balances the worker processes against the detector threads within each of them: the cores 
+    that are not needed for correcting concurrent pages run the circle detectors of a page.
+    It returns the number of processes and of threads per process.
+    """
+    cpu = cpu or mp.cpu_count()
+    processes = cpu if pages is None else max(1, min(cpu, pages))
+    if threads is None:
+        threads = min(detectors or len(Correct.DETECTORS), max(1, cpu // processes))
+    else:
+        processes = max(1, min(processes, cpu // threads))
+    return processes, threads
+
+def student_pdf(task):
+    """
+    Writes the corrected pdf file of a student, it runs in the pool of collect_students
+    """
+    student_id, files, filename = task
+    with StreamingPdfWriter(filename, 72) as output_pdf:
+        for f in files:
+            output_pdf.add_jpeg(f)
+    return student_id, filename, len(files)
+
 class Correct:
     """
     This class will operate on a directory with a set of pages and perform the correction 
     according to the information stored in the qrcodes
     """
-    def __init__(self, sorted, corrected, data_filename, resolution, compression, use_page_answers=False):
+    # registry of the circle detectors by name (label of the superimposed mask and detector), 
+    # from the cheapest to the most expensive one
+    DETECTORS = { 'contour': ('Contour', 'detect_circles_edges'), 'blob': ('Blob', 'detect_circles_blob'), 
+                  'hough': ('Hough', 'detect_circles_hough'), 'laplacian': ('Laplacian', 'detect_circles_laplacian') }
+    # the blob detector is not used by default, it marks also the empty bubbles as filled on some scans
+    DEFAULT_DETECTORS = ['contour', 'hough', 'laplacian']
+
+    # fill ratios of the inner square of the predicted bubbles that are clearly empty or filled (template fast path)
+    TEMPLATE_EMPTY = 0.35
+    TEMPLATE_FILLED = 0.65
+
+    def __init__(self, sorted, corrected, data_filename, resolution, compression, use_page_answers=False, threads=None, template=True, agreement=2, detectors=None, headless=False, per_student=None, combined=True, index=None):
         self.sorted = sorted
         self.corrected = corrected
         self.data_filename = data_filename
         self.resolution = resolution
         self.compression = compression
         self.use_page_answers = use_page_answers
+        self.store = None
+        # number of detector threads per process, None for balancing them against the processes
+        self.detector_threads = threads
+        self.threads = 1
+        self.executor = None
+        # number of detectors that must agree on every question for stopping the cascade (0 for running all of them)
+        self.agreement = agreement
+        # the circle detectors used, in order
+        detectors = detectors or Correct.DEFAULT_DETECTORS
+        unknown = [d for d in detectors if d not in Correct.DETECTORS]
+        if unknown:
+            raise ValueError(f"Unknown circle detectors {', '.join(unknown)}, should be among {', '.join(Correct.DETECTORS)}")
+        self.detectors = list(detectors)
+        # number of detectors run on the current page, with their time and agreement with the majority
+        self.needed = 0
+        self.page_statistics = {}
+        # whether to read the answers at the bubble positions predicted by the metadata first
+        self.template = template
+        # number of cpus available for the correction (all of them by default)
+        self.cpu = None
+        # registry of the latest occurrence of each page and scan position of the current one, when
+        # the pages are handed over by a producer (see the Pipeline class)
+        self.latest = None
+        self.position = None
+        # whether to record the annotations of the pages instead of drawing them, they are rendered
+        # only for the pages deserving attention (and for all of them by the render method)
+        self.headless = headless
+        self.annotations = Correct.annotations_filename(corrected) if corrected else None
+        # directory of the corrected pdf file of each student (if any), with the index of the files,
+        # and whether to collect all the corrected pages into the corrected pdf file as well
+        self.per_student = per_student
+        self.index = index
+        self.combined = combined
 
     def correct(self):
-        logger.info('Creating and preparing tmp directory')
-        if os.path.exists('tmp'):
-            rmtree('tmp')
-        os.mkdir('tmp')
-        with TinyDB(f"{self.data_filename}.tmp") as db:
-            if 'correction' in db.tables():
-                db.drop_table('correction')
-        self.tasks_queue = mp.JoinableQueue()
-        self.watch_queue = mp.Queue()
-        self.results_mutex = mp.RLock()
-        self.task_done = mp.Condition(self.results_mutex)
-        self.results = mp.Value('i', 0, lock=self.results_mutex)
         files = 0
-        for f in sorted(glob.glob(os.path.join(self.sorted, '*.png'))):
-            self.tasks_queue.put(f)
+        if PageStore.exists(self.sorted):
+            # the pages are read from the container, the filename is the one they would have in the directory
+            self.store = PageStore(os.path.join(self.sorted, CONTAINER_NAME))
+            filenames = [os.path.join(self.sorted, f"{key}.png") for key in self.store.keys()]
+        else:
+            filenames = sorted(glob.glob(os.path.join(self.sorted, '*.png')))
+        self.prepare(pages=len(filenames))
+        # the qrcodes are decoded again only for the pages without (up to date) metadata stored by sort
+        metadata = load_metadata(self.sorted, self.store)
+        logger.info(f"Found the qrcode metadata of {len(metadata)} pages")
+        for f in filenames:
+            self.tasks_queue.put((f, None, metadata.get(".".join(os.path.basename(f).split(".")[:-1])), None))
             files += 1
         click.secho(f"Correcting {files} pages", fg='red', underline=True)
         with click.progressbar(length=files, label='Correcting',
                                bar_template='%(label)s |%(bar)s| %(info)s',
                                fill_char=click.style(u'█', fg='cyan'),
                                empty_char=' ', show_pos=True) as bar:
-            for _ in range(mp.cpu_count()):
+            for _ in range(self.processes):
                 self.tasks_queue.put(None)
-            pool = mp.Pool(mp.cpu_count(), self.worker_main)
+            pool = mp.Pool(self.processes, self.worker_main)
             pool.close()
             prev = 0
-            while not self.tasks_queue.empty():
+            # all the pages must be done before gathering their outcome
+            while prev < files:
                 self.results_mutex.acquire()
-                self.task_done.wait_for(lambda: prev <= self.results.value)
+                self.task_done.wait_for(lambda: prev < self.results.value)
                 bar.update(self.results.value - prev)
                 prev = self.results.value
                 self.results_mutex.release()
         click.secho('Correction finished', fg='red', underline=True)
+        table = qrdecoder.statistics_table(self.decoding_statistics)
+        if table:
+            click.secho('Qrcode decoding statistics', fg='green')
+            click.echo(table)
+        self.collect()
+
+    def prepare(self, tasks_queue=None, pages=None):
+        """
+        Prepares the tmp directory and the shared structures, the tasks queue can be
+        provided by a producer of already decoded pages (see the Pipeline class).
+        The number of pages, if known, drives the scheduling of processes and detector threads.
+        """
+        self.processes, self.threads = schedule(pages, self.detector_threads, self.cpu, len(self.detectors))
+        logger.info(f"Correcting with {self.processes} processes and {self.threads} detector threads each")
+        logger.info('Creating and preparing tmp directory')
+        if os.path.exists('tmp'):
+            rmtree('tmp')
+        os.mkdir('tmp')
+        if self.headless:
+            open(self.annotations, 'w').close()
+        self.tasks_queue = tasks_queue if tasks_queue is not None else mp.JoinableQueue()
+        self.watch_queue = mp.Queue()
+        # the outcome of each page is handed over to the parent, which writes all of them at once
+        self.results_queue = mp.Queue()
+        self.results_mutex = mp.RLock()
+        self.task_done = mp.Condition(self.results_mutex)
+        self.results = mp.Value('i', 0, lock=self.results_mutex)
+        self.decoding_statistics = qrdecoder.shared_statistics(self.results_mutex)
+        # number of pages by number of detectors needed
+        self.detectors_needed = [0] * (len(self.detectors) + 1)
+        # runs, time and agreements with the majority of each detector
+        self.detector_statistics = [0.0] * (3 * len(self.detectors))
+
+    def gather(self):
+        """
+        Gathers the outcome of the pages from the workers (one for each page processed, None if the page
+        has not been corrected), it returns the corrections and accumulates the detector statistics
+        """
+        corrections = []
+        for _ in range(self.results.value):
+            result = self.results_queue.get()
+            if result is None:
+                continue
+            correction, needed, page_statistics, filename, position = result
+            if not self.is_latest(filename, position):
+                logger.warning(f"Page {os.path.basename(filename)} scanned twice, only the last one is kept")
+                continue
+            corrections.append(correction)
+            self.detectors_needed[needed] += 1
+            for name, statistics in page_statistics.items():
+                k = 3 * self.detectors.index(name)
+                self.detector_statistics[k:k + 3] = [a + b for a, b in zip(self.detector_statistics[k:k + 3], statistics)]
+        return corrections
+
+    def collect(self):
+        """
+        Collects the corrected pages into a single pdf file and updates the data file
+        """
+        corrections = self.gather()
+        table = self.detectors_table()
+        if table:
+            click.secho('Circle detectors needed', fg='green')
+            click.echo(table)
+        table = self.detector_statistics_table()
+        if table:
+            click.secho('Circle detectors statistics', fg='green')
+            click.echo(table)
         delete_default = True
         watch = set()
         if not self.watch_queue.empty():
@@ -92,29 +233,16 @@ class Correct:
                 filename = os.path.basename(w[0])
                 filename = os.path.join('tmp', ".".join(filename.split(".")[:-1]) + ".jpg")
                 click.secho(f'\t{filename} {w[1]}', fg='yellow')   
-        # Collecting all corrected exams into a single pdf file
-        click.secho("Collecting all corrected exams into a single pdf file", fg="green")
+        if self.headless:
+            # only the pages deserving attention are rendered, the others can be by the render command
+            watched = set(w[0] for w in watch)
+            for entry in Correct.load_annotations(self.annotations).values():
+                if entry['filename'] in watched:
+                    self.render_page(entry)
+            click.secho(f"Annotations of the corrected pages recorded in {self.annotations}", fg="green")
         files = sorted(glob.glob(os.path.join('tmp', "*.jpg")))
-        output_pdf = PdfWriter()
-        old_student_id = None
-        with click.progressbar(length=len(files), label="Merging corrections",
-                               bar_template='%(label)s |%(bar)s| %(info)s',
-                               fill_char=click.style(u'█', fg='cyan'),
-                               empty_char=' ', show_pos=True) as bar:
-            for i, filename in enumerate(files):
-                with io.BytesIO() as f:
-                    f.write(img2pdf.convert(filename))              
-                    f.seek(0)
-                    student_id = os.path.basename(filename).split("-")[0]  
-                    if student_id != old_student_id:                
-                        output_pdf.append(PdfReader(f, strict=False), outline_item=f'Student {student_id}')
-                        old_student_id = student_id
-                    else:
-                        output_pdf.append(PdfReader(f, strict=False))
-                bar.update(1)
-        click.secho("Writing pdf file", fg="green")
-        with open(self.corrected, 'wb') as f:
-            output_pdf.write(f)
+        if files or not self.headless:
+            self.merge(files)
 
         # TODO: seems not to work, to be tested (the pages with images are rendered as blank files)
         # Marking collected pdf with the student_id
@@ -137,54 +265,44 @@ class Correct:
         # Update the data file and output the corrected excel file
         click.secho("Updating the database file", fg="green")
         data = {}
-        with TinyDB(f"{self.data_filename}.tmp") as db1, TinyDB(self.data_filename) as db2:
-            table = db1.table('correction')
-            students = set()
-            for item in table.all():
-                students.add(item['student_id'])
-            Correction = Query()
-            for student in students:
-                data[student] = { 'correct_answers': [], 'given_answers': [] }
-                results = table.search(Correction.student_id == student)
-                results = sorted(results, key=lambda r: int(r['page']))
-                for page in results:
-                    data[student]['correct_answers'] += list(map(list, page['correct_answers']))
-                    data[student]['given_answers'] += list(map(list, page['detected_answers']))
-            if 'correction' in db2.tables():
-                db2.drop_table('correction')
-            table = db2.table('correction')
-            for student in data:
-                table.insert({ 'student_id': student, **data[student] })   
-            db2.drop_table('statistics')
-            statistics = db2.table('statistics')    
-            Statistics = Query()       
+        for page in sorted(corrections, key=lambda r: (r['student_id'], int(r['page']))):
+            student = data.setdefault(page['student_id'], { 'correct_answers': [], 'given_answers': [] })
+            student['correct_answers'] += page['correct_answers']
+            student['given_answers'] += page['detected_answers']
+        # the statistics of each question, by question file and index
+        statistics = {}
+        with TinyDB(self.data_filename) as db:
+            # the corrections are stored first, so that they are kept even if the statistics fail
+            if 'correction' in db.tables():
+                db.drop_table('correction')
+            db.table('correction').insert_multiple({ 'student_id': student, **data[student] } for student in data)
             # check consistency of correct answers (apriori/encoded)
-            for exam in db2.table('exams').all():
-                data = table.get(Correction.student_id == exam['student_id'])
-                if data is not None and any(set(d) != set(e) for d, e in zip(data['correct_answers'], exam['answers'])):                    
-                    for i, (d, e) in enumerate(zip(data['correct_answers'], exam['answers'])):
+            for exam in db.table('exams').all():
+                correction = data.get(exam['student_id'])
+                if correction is not None and any(set(d) != set(e) for d, e in zip(correction['correct_answers'], exam['answers'])):                    
+                    for i, (d, e) in enumerate(zip(correction['correct_answers'], exam['answers'])):
                         if set(e) != set(d):
                             message = f"Warning: correct answers in {self.data_filename} for student {exam['student_id']}, question {i + 1} do not match with those encoded in the exam sheets: {set(d)} in the sheet, {set(e)} in db"
                             click.secho(message, fg="yellow")
-                elif data is None:
+                elif correction is None:
                     continue               
-                for i, q in enumerate(exam['questions']):
-                    question = statistics.get((Statistics.question_file == q[0]) & (Statistics.index == q[1]))
-                    given_answer = decode_answers(data['given_answers'][i], q[3])
-                    correct_answer = decode_answers(data['correct_answers'][i], q[3])
-
-                    if question is None:
-                        question = { 
-                            'question_file': q[0], 
-                            'index': q[1], 
-                            'answers': [0] * len(q[3]), 
-                            'correct_answers': correct_answer,
-                            'total': 0,
-                            'incorrect': 0, 
-                            'correct': 0, 
-                            'partially_correct': 0,
-                            'unanswered': 0
-                        }
+                if len(correction['given_answers']) < len(exam['questions']):
+                    click.secho(f"Warning: only {len(correction['given_answers'])} of the {len(exam['questions'])} questions of student {exam['student_id']} have been corrected (missing pages?)", fg="yellow")
+                # the statistics consider only the questions corrected
+                for q, given, correct in zip(exam['questions'], correction['given_answers'], correction['correct_answers']):
+                    given_answer = decode_answers(given, q[3])
+                    correct_answer = decode_answers(correct, q[3])
+                    question = statistics.setdefault((q[0], q[1]), { 
+                        'question_file': q[0], 
+                        'index': q[1], 
+                        'answers': [0] * len(q[3]), 
+                        'correct_answers': correct_answer,
+                        'total': 0,
+                        'incorrect': 0, 
+                        'correct': 0, 
+                        'partially_correct': 0,
+                        'unanswered': 0
+                    })
                     question['total'] += 1
                     if all(g == c for g, c in zip(given_answer, correct_answer)):
                         question['correct'] += 1
@@ -197,43 +315,172 @@ class Correct:
                     for i in range(len(given_answer)):
                         if given_answer[i]:
                             question['answers'][i] += 1 
-                    statistics.upsert(question, (Statistics.question_file == q[0]) & (Statistics.index == q[1]))
-        click.secho("Removing temporary files", fg="green")
-        os.remove(f"{self.data_filename}.tmp")
-                        
+            db.drop_table('statistics')
+            db.table('statistics').insert_multiple(statistics.values())
+
+    @staticmethod
+    def student_of(filename):
+        # the student_id might contain dashes because of old-style matriculation numbers
+        return ".".join(os.path.basename(filename).split(".")[:-1]).rsplit("-", 1)[0]
+
+    def merge(self, files):
+        """
+        Collects the corrected pages (jpg files) into the corrected pdf file and/or into the pdf file of each student
+        """
+        if self.combined:
+            click.secho("Collecting all corrected exams into a single pdf file", fg="green")
+            self.collect_combined(files)
+        if self.per_student:
+            click.secho(f"Collecting the corrected exams of each student into {self.per_student}", fg="green")
+            self.collect_students(files)
+
+    def collect_combined(self, files):
+        """
+        Merges the corrected pages into the corrected pdf file, with an outline item for each student
+        """
+        old_student_id = None
+        # the corrected pages are written at 72 dpi
+        with StreamingPdfWriter(self.corrected, 72) as output_pdf, \
+             click.progressbar(length=len(files), label="Merging corrections",
+                               bar_template='%(label)s |%(bar)s| %(info)s',
+                               fill_char=click.style(u'█', fg='cyan'),
+                               empty_char=' ', show_pos=True) as bar:
+            for filename in files:
+                student_id = Correct.student_of(filename)
+                if student_id != old_student_id:
+                    output_pdf.add_jpeg(filename, outline=f'Student {student_id}')
+                    old_student_id = student_id
+                else:
+                    output_pdf.add_jpeg(filename)
+                bar.update(1)
+
+    def collect_students(self, files):
+        """
+        Writes the corrected pdf file of each student, in parallel, and the index of the files
+        """
+        os.makedirs(self.per_student, exist_ok=True)
+        students = {}
+        for filename in files:
+            students.setdefault(Correct.student_of(filename), []).append(filename)
+        tasks = [(student_id, pages, os.path.join(self.per_student, f"{student_id}.pdf")) for student_id, pages in students.items()]
+        index = []
+        with mp.Pool(max(1, min(mp.cpu_count(), len(tasks)))) as pool, \
+             click.progressbar(length=len(tasks), label="Writing students files",
+                               bar_template='%(label)s |%(bar)s| %(info)s',
+                               fill_char=click.style(u'█', fg='cyan'),
+                               empty_char=' ', show_pos=True) as bar:
+            for student_id, filename, pages in pool.imap_unordered(student_pdf, tasks):
+                index.append({ 'student_id': student_id, 'file': filename, 'pages': pages })
+                bar.update(1)
+        if self.index:
+            # the files are relative to the index, so that they can be moved together
+            index = pd.DataFrame(sorted(index, key=lambda i: i['student_id']), columns=['student_id', 'file', 'pages'])
+            index['file'] = index['file'].map(lambda f: os.path.relpath(f, os.path.dirname(self.index)))
+            index.to_csv(self.index, index=False)
+
+    def render(self, students=None):
+        """
+        Renders the pages recorded by a headless correction (only those of the given students, if any)
+        and collects them into the corrected pdf file
+        """
+        if PageStore.exists(self.sorted):
+            self.store = PageStore(os.path.join(self.sorted, CONTAINER_NAME))
+        entries = Correct.load_annotations(self.annotations)
+        if students:
+            entries = { key: entry for key, entry in entries.items() if Correct.student_of(entry['filename']) in students }
+        os.makedirs('tmp', exist_ok=True)
+        with click.progressbar(entries.values(), label='Rendering',
+                               bar_template='%(label)s |%(bar)s| %(info)s',
+                               fill_char=click.style(u'█', fg='cyan'),
+                               empty_char=' ', show_pos=True) as bar:
+            for entry in bar:
+                self.render_page(entry)
+        files = [os.path.join('tmp', f"{key}.jpg") for key in sorted(entries)]
+        self.merge(files)
+        for filename in files:
+            os.remove(filename)
+        if not os.listdir('tmp'):
+            os.rmdir('tmp')
+
+    @staticmethod
+    def annotations_filename(corrected):
+        return ".".join(corrected.split(".")[:-1]) + "-annotations.jsonl"
+
+    @staticmethod
+    def load_annotations(filename):
+        """
+        Reads the annotations recorded by a headless correction, by page key
+        """
+        entries = {}
+        with open(filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # possibly a line truncated by an interrupted run
+                    continue
+                entries[entry['key']] = entry
+        return entries
         
     def worker_main(self):    
+        if self.threads > 1:
+            self.executor = ThreadPoolExecutor(self.threads)
         while True:
-            filename = self.tasks_queue.get()
-            if filename is None:
+            task = self.tasks_queue.get()
+            if task is None:
+                if self.executor is not None:
+                    self.executor.shutdown()
                 break
+            # the image is present only if handed over by the producer, the qrcode metadata also if stored by sort
+            # (the producer also tells the position of the page within the scans)
+            filename, image, metadata, self.position = task
+            result = None
             try:
-                detected_answers, correct_answers = self.process(filename)
+                if not self.is_latest(filename, self.position):
+                    # the page has been scanned again later on, that occurrence is corrected instead
+                    continue
+                self.needed = 0
+                self.page_statistics = {}
+                detected_answers, correct_answers = self.process(filename, image, metadata)
                 if correct_answers: # probably no question in current file           
                     *student, page = ".".join(os.path.basename(filename).split(".")[:-1]).split("-")
                     # this is due because of old-style matriculation numbers
                     student = "-".join(student)
-                    self.results_mutex.acquire()
-                    self.append_correction(student, page, list(map(list, detected_answers)), list(map(list, correct_answers)))
-                    self.results_mutex.release()
+                    correction = { 
+                        "student_id": student, 
+                        "page": page, 
+                        "detected_answers": list(map(list, detected_answers)),
+                        "correct_answers": list(map(list, correct_answers))
+                    }
+                    result = (correction, self.needed, self.page_statistics, filename, self.position)
             except Exception as e:
                 click.secho(f"\nIn file {filename}\n" + str(e), fg="yellow")
             finally:
+                # the result is queued before counting the page, the parent gets one for each page counted
+                self.results_queue.put(result)
                 self.results_mutex.acquire()
+                qrdecoder.backends.collect(self.decoding_statistics)
                 self.results.value += 1
                 self.task_done.notify()
                 self.results_mutex.release()
                 self.tasks_queue.task_done()
 
-    def process(self, filename):
+    def process(self, filename, image=None, metadata=None):
         offset = 5
-        image = cv2.imread(filename)
-        metadata = qrdecoder.decode(image, True)
-        if metadata.get('rotated', False):
-            image = cv2.rotate(image, cv2.ROTATE_180)
+        if image is None:
+            image = self.read(filename)
+        if len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        # whether the page has been rotated here (i.e., it must be rotated again when rendering it later)
+        rotated = False
+        if metadata is None:
+            metadata = qrdecoder.decode(image, True)
+            if metadata.get('rotated', False):
+                image = cv2.rotate(image, cv2.ROTATE_180)
+                rotated = True
+        annotations = Overlay()
 
         if metadata['range'] == (0, 0): # no question and markers in current page
-            self.write(filename, image)
+            self.annotate(filename, image, rotated, annotations)
             return [], []
         tl, br = metadata['top_left'], metadata['bottom_right']
         # prepare roi
@@ -247,7 +494,7 @@ class Correct:
         p0 = np.array([max(0, p0[0] - expand_x), max(0, p0[1] - expand_y)])
         p1 =  np.array([min(image.shape[1], p1[0] + expand_x), min(image.shape[0], p1[1] + expand_y)])
         roi = image[p0[1]:p1[1], p0[0]:p1[0]] 
-        cv2.rectangle(image, tuple(map(int, p0 - offset)), tuple(map(int, p1 + offset)), BLUE, 3)        
+        annotations.rectangle(tuple(map(int, p0 - offset)), tuple(map(int, p1 + offset)), BLUE, 3)
 
         page_answers = None
         if self.data_filename and self.use_page_answers:
@@ -256,42 +503,19 @@ class Correct:
                 exam = db.table('exams').search(Exam.student_id == metadata['student_id'])
                 if len(exam) > 0:
                     page_answers = exam[0]['answers'][metadata['range'][0] - 1:metadata['range'][1]]
-        # contour detection
-        correction = [None] * 4    
-        try:
-            binary, circles, empty_circles = Correct.detect_circles_edges(roi, metadata)
-            # process result        
-            correction[0], mask = Correct.process_circles(roi, binary, circles, empty_circles, metadata, page_answers)
-            image = Correct.add_superimposed(image, mask, roi, p0, p1, 'Contour')
-        except Exception as e:
-            click.secho(f"\nFailed Contour Detection for {filename}", fg="yellow")
-            click.echo(str(e))
-        # blob detection
-        # TODO: temporarily disabled, seems to have some troubles that need further investigation
-        try:
-            binary, circles, empty_circles = Correct.detect_circles_blob(roi, metadata)            
-            correction[1], mask = Correct.process_circles(roi, binary, circles, empty_circles, metadata, page_answers)            
-            image = Correct.add_superimposed(image, mask, roi, p0, p1, 'Blob')
-        except Exception as e:
-            click.secho(f"\nFailed Blob for {filename}", fg="yellow")
-            click.echo(f"{e}")
-        # laplacian detection
-        try:
-            binary, circles, empty_circles = Correct.detect_circles_laplacian(roi, metadata)
-            correction[2], mask = Correct.process_circles(roi, binary, circles, empty_circles, metadata, page_answers)
-            image = Correct.add_superimposed(image, mask, roi, p0, p1, 'Laplacian')
-        except Exception as e:
-            click.secho(f"Failed Laplacian for {filename}", fg="yellow")
-            click.echo(str(e))
-        # hough detection
-        try:
-            binary, circles, empty_circles = Correct.detect_circles_hough(roi, metadata)
-            correction[3], mask = Correct.process_circles(roi, binary, circles, empty_circles, metadata, page_answers)
-            image = Correct.add_superimposed(image, mask, roi, p0, p1, 'Hough')
-        except Exception as e:
-            click.secho(f"Failed Hough for {filename}", fg="yellow")
-            click.echo(f"{e}")
-#            click.echo(f"{traceback.format_exc()}")
+        preprocessed = RoiPreprocessing(roi)
+        # the fast path runs the detectors only on the rows whose answers are not clear
+        template = self.template_correction(filename, preprocessed, metadata, page_answers) if self.template else None
+        if template is not None:
+            majority, correct, mask = template
+            annotations.superimpose(mask, p0, p1, 'Template')
+        else:
+            detected = self.detect(filename, preprocessed, metadata, page_answers)
+            for name, (_, mask) in detected:
+                if mask is not None:
+                    annotations.superimpose(mask, p0, p1, Correct.DETECTORS[name][0])
+            majority, correct = self.majority_correction(filename, [c for _, (c, _) in detected])  
+            self.record_agreement(detected, majority)
 
         # TODO: currently here just to check, before becoming another method
         # def non_max_suppression(boxes, overlap_thresh=0.8):
@@ -330,17 +554,224 @@ class Correct:
         #         y = y + p0[1]
         #         cv2.rectangle(image, (x, y), (x + w, y + h), RED, 1, cv2.LINE_AA)
 
-        majority, correct = self.majority_correction(filename, correction)  
         given_text = f"Given answers: {' '.join(','.join(a) for a in majority)}"
         correct_text = f"Correct answers: {' '.join(','.join(a) for a in correct)}"
         (width, height), _ =  cv2.getTextSize(given_text, cv2.FONT_HERSHEY_SIMPLEX, 1, 3)
-        cv2.putText(image, given_text, (metadata['bottom_right'][0] // 4, metadata['bottom_right'][1] - 4 * height), cv2.FONT_HERSHEY_SIMPLEX, 1, MAGENTA, 3)
-        cv2.putText(image, correct_text, (metadata['bottom_right'][0] // 4, metadata['bottom_right'][1] - height), cv2.FONT_HERSHEY_SIMPLEX, 1, BLUE, 3)
-        self.write(filename, image)
+        annotations.putText(given_text, (metadata['bottom_right'][0] // 4, metadata['bottom_right'][1] - 4 * height), cv2.FONT_HERSHEY_SIMPLEX, 1, MAGENTA, 3)
+        annotations.putText(correct_text, (metadata['bottom_right'][0] // 4, metadata['bottom_right'][1] - height), cv2.FONT_HERSHEY_SIMPLEX, 1, BLUE, 3)
+        self.annotate(filename, image, rotated, annotations)
 
         return majority, correct
         
-    def majority_correction(self, filename, correction):
+    def detect(self, filename, preprocessed, metadata, page_answers=None):
+        """
+        Runs the circle detectors on the (preprocessed) roi as a cascade, from the cheapest to the most
+        expensive one, stopping as soon as enough of them agree on every question.
+        The detectors of each wave run concurrently if the worker has detector threads (most of 
+        their time is spent in OpenCV and scikit-image calls that release the GIL).
+        It returns the name, the correction and the mask of each detector run, None if it failed.
+        """
+        def run(name):
+            label, detector = Correct.DETECTORS[name]
+            start = time.perf_counter()
+            try:
+                detector = getattr(Correct, detector) if isinstance(detector, str) else detector
+                circles, empty_circles = detector(preprocessed, metadata)
+                return Correct.process_circles(preprocessed, circles, empty_circles, metadata, page_answers)
+            except Exception as e:
+                click.secho(f"\nFailed {label} detection for {filename}", fg="yellow")
+                click.echo(str(e))
+                return None, None
+            finally:
+                statistics = self.page_statistics.setdefault(name, [0, 0.0, 0])
+                statistics[0] += 1
+                statistics[1] += time.perf_counter() - start
+
+        detected = []
+        pending = list(self.detectors)
+        while pending:
+            # the first wave is able to reach the agreement on its own
+            size = max(self.threads, self.agreement - len(detected), 1)
+            wave, pending = pending[:size], pending[size:]
+            if self.executor is None:
+                detected += [(name, run(name)) for name in wave]
+            else:
+                futures = [(name, self.executor.submit(run, name)) for name in wave]
+                detected += [(name, future.result()) for name, future in futures]
+            if self.agreement and Correct.agreed([c for _, (c, _) in detected], self.agreement):
+                break
+        self.needed = max(self.needed, len(detected))
+        return detected
+
+    @classmethod
+    def register_detector(cls, name, label, detector):
+        """
+        Registers a further circle detector: a function of the preprocessed roi and of the metadata
+        returning the filled and the empty circles (the preprocessing it needs is taken from the roi
+        preprocessing, so that it is shared with the other detectors)
+        """
+        cls.DETECTORS[name] = (label, detector)
+
+    def record_agreement(self, detected, majority):
+        for name, (correction, _) in detected:
+            if correction is not None and all(set(c[0]) == set(m) for c, m in zip(correction, majority)):
+                self.page_statistics[name][2] += 1
+
+    @staticmethod
+    def agreed(correction, agreement):
+        """
+        Checks whether, for every question, the same answers are given by at least agreement 
+        detectors and by the majority of those that succeeded
+        """
+        correction = [c for c in correction if c is not None]
+        if len(correction) < agreement or any(len(c) != len(correction[0]) for c in correction):
+            return False
+        for i in range(len(correction[0])):
+            _, votes = Counter(frozenset(c[i][0]) for c in correction).most_common(1)[0]
+            if votes < agreement or votes <= len(correction) / 2:
+                return False
+        return True
+
+    def detector_statistics_table(self):
+        rows = []
+        for i, name in enumerate(self.detectors):
+            runs, seconds, agreements = self.detector_statistics[3 * i:3 * i + 3]
+            if runs:
+                rows.append([Correct.DETECTORS[name][0], int(runs), f"{1000 * seconds / runs:.1f}", f"{agreements / runs:.0%}"])
+        if not rows:
+            return None
+        return tabulate(rows, headers=["Detector", "Runs", "Mean time (ms)", "Agreement"], tablefmt="simple")
+
+    def detectors_table(self):
+        rows = [[needed if needed else "0 (template)", pages] for needed, pages in enumerate(self.detectors_needed) if pages]
+        if not rows:
+            return None
+        return tabulate(rows, headers=["Detectors", "Pages"], tablefmt="simple")
+
+    def template_correction(self, filename, preprocessed, metadata, page_answers=None):
+        """
+        Fast path correction: the answers are read at the bubble positions predicted from the metadata
+        and the reference column, the detectors run only on the strips of the rows that are not clear.
+        It returns the given and correct answers together with the mask, or None if the page needs
+        the full detection.
+        """
+        # the reference column is found by the first configured detector, whose run is counted as any other
+        name = self.detectors[0]
+        detector = Correct.DETECTORS[name][1]
+        statistics = self.page_statistics.setdefault(name, [0, 0.0, 0])
+        start = time.perf_counter()
+        try:
+            detector = getattr(Correct, detector) if isinstance(detector, str) else detector
+            circles, _ = detector(preprocessed, metadata)
+        except Exception as e:
+            logger.debug(f"{Correct.DETECTORS[name][0]} detection of the reference column failed for {filename}: {e}")
+            return None
+        finally:
+            statistics[0] += 1
+            statistics[1] += time.perf_counter() - start
+        try:
+            template = Correct.template_rows(preprocessed, metadata, circles, page_answers)
+        except Exception as e:
+            logger.debug(f"Template correction failed for {filename}: {e}")
+            return None
+        if template is None:
+            return None
+        reference_circles, correction, mask = template
+        reference_radius = np.max(np.dot(metadata['bsize'], metadata['scaling']) / 2)
+        # each strip spans the row, without reaching the neighbouring ones
+        ys = [c[1] for c in reference_circles]
+        half = min([2 * reference_radius] + [(y2 - y1) / 2 for y1, y2 in zip(ys, ys[1:])])
+        majority, correct = [], []
+        # the questions to watch and the agreements are committed only if all the strips succeed,
+        # otherwise the page is corrected again by the full detection
+        watch, agreements = [], []
+        for i, (reference_circle, row) in enumerate(zip(reference_circles, correction)):
+            if row is None:
+                top, bottom = max(0, int(reference_circle[1] - half)), min(preprocessed.shape[0], int(reference_circle[1] + half))
+                strip = RoiPreprocessing(preprocessed.roi[top:bottom])
+                row_metadata = { **metadata, 'page_correction': metadata['page_correction'][i:i + 1] }
+                detected = self.detect(filename, strip, row_metadata, page_answers[i:i + 1] if page_answers is not None else None)
+                if all(c is None for _, (c, _) in detected):
+                    return None
+                row_majority, row_correct = self.majority_correction(filename, [c for _, (c, _) in detected], first=i, watch=watch)
+                agreements.append((detected, row_majority))
+                mask.paste(next(m for _, (_, m) in detected if m is not None), top)
+                row = (row_majority[0], row_correct[0])
+            majority.append(set(row[0]))
+            correct.append(row[1])
+        for w in watch:
+            self.watch_queue.put(w)
+        for detected, row_majority in agreements:
+            self.record_agreement(detected, row_majority)
+        # the reference column detector agrees with the answers read at the positions it predicted
+        statistics[2] += 1
+        return majority, correct, mask
+
+    @staticmethod
+    def template_rows(preprocessed, metadata, circles, page_answers=None, offset=5, xdistance=1.25, max_answers=10):
+        """
+        Predicts the bubbles of each question (on the right of its reference circle, among the circles found
+        by a detector) and reads their fill 
+        ratio. It returns the reference circles, the correction of each row (None if its fill ratios are 
+        not clearly empty or filled) and the mask, or None if the reference column does not match the 
+        questions of the page.
+        """
+        if not circles:
+            return None
+        # the reference circles are those whose center is almost in the same column as the leftmost one
+        pivot = min(circles)
+        reference_circles = sorted((c for c in circles if abs(c[0] - pivot[0]) <= pivot[2]), key=lambda c: c[1])
+        if len(reference_circles) != len(metadata['page_correction']):
+            return None
+        reference_radius = np.max(np.dot(metadata['bsize'], metadata['scaling']) / 2)
+        reference_area = reference_radius * reference_radius * math.pi
+        # the predicted bubbles, for all the rows at once
+        centers = np.array([c[:2] for c in reference_circles], dtype=float)
+        steps = np.arange(1, max_answers + 1) * xdistance * 2 * reference_radius
+        bubbles = np.stack([(centers[:, 0, None] + steps).ravel(), np.repeat(centers[:, 1], max_answers), 
+                            np.full(len(centers) * max_answers, reference_radius)], axis=1)
+        # a bubble is printed if there is something below it (as for the phantom circles)
+        printed = (Correct.circles_filled_area(preprocessed.integral, bubbles) >= 0.1 * reference_area).reshape(-1, max_answers)
+        # the fill ratio is measured in the inner square, so that the border of the bubble is not considered
+        inner = bubbles * [1, 1, 0.6]
+        ratios = (Correct.circles_filled_area(preprocessed.integral, inner) / (1.2 * reference_radius + 1) ** 2).reshape(-1, max_answers)
+
+        mask = Overlay(preprocessed.shape)
+        correction = []
+        for i, reference_circle in enumerate(reference_circles):
+            correct_res = set(metadata['page_correction'][i] if page_answers is None else page_answers[i])
+            answers = max_answers if printed[i].all() else int(np.argmin(printed[i]))
+            row = ratios[i, :answers]
+            all_res = set(chr(j + ord('A')) for j in range(answers))
+            if answers == 0 or not correct_res <= all_res or np.any((row > Correct.TEMPLATE_EMPTY) & (row < Correct.TEMPLATE_FILLED)):
+                correction.append(None)
+                continue
+            answers_res = set(chr(j + ord('A')) for j in np.flatnonzero(row >= Correct.TEMPLATE_FILLED))
+            Correct.highlight_circle(mask, reference_circle, CYAN)
+            for j, ratio in enumerate(row):
+                c = tuple(map(int, bubbles[i * max_answers + j]))
+                r = chr(j + ord('A'))
+                mask.putText(f"{ratio:0>4.0%}", tuple(np.array(c[:2]) - np.array([c[2], c[2] + 2 * offset])), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, MAGENTA, 2)
+                mask.circle(c[:2], c[2], alpha(YELLOW, 0.3), -1)
+                if r in answers_res:
+                    mask.circle(c[:2], c[2], alpha(GREEN if r in correct_res else RED, 1.0), -1)
+                elif r in correct_res:
+                    mask.circle(c[:2], c[2], alpha(ORANGE, 1.0), -1)
+            p = np.array(reference_circle[0:2]) + [-reference_circle[2], reference_circle[2] - 100]
+            tmp = ("".join(sorted(answers_res)) if answers_res else "None")
+            tmp += "/" + ("".join(sorted(correct_res)) if correct_res else "None")
+            mask.putText(tmp, tuple(p), cv2.FONT_HERSHEY_SIMPLEX, 1, MAGENTA, 3)
+            correction.append((answers_res, correct_res))
+        return reference_circles, correction, mask
+
+    def read(self, filename):
+        if self.store is not None:
+            image = self.store.read(".".join(os.path.basename(filename).split(".")[:-1]))
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return cv2.imread(filename)
+
+    def majority_correction(self, filename, correction, first=0, watch=None):
         correction = list(filter(lambda c: c is not None, correction))
         correct_answers = list(map(lambda c: c[1], correction[0]))
         correction = [list(map(lambda c: c[0], correction[i])) for i in range(len(correction))]
@@ -358,69 +789,85 @@ class Correct:
                 if counter[a] >= len(correction) / 2:
                     tmp.append(a)
             if all(c1[i] != c2[i] for c1, c2 in combinations(correction, 2)):
-                self.watch_queue.put((filename, i))
+                # the questions to watch are possibly collected by the caller instead
+                if watch is None:
+                    self.watch_queue.put((filename, first + i))
+                else:
+                    watch.append((filename, first + i))
             majority.append(set(tmp))                        
         return majority, correct_answers
 
-    @staticmethod
-    def add_superimposed(image, mask, roi, p0, p1, method):
-        superimposed = cv2.bitwise_and(mask, roi)
-        prev_x = image.shape[1]
-        image = cv2.copyMakeBorder(image, 0, 0, 0, superimposed.shape[1], cv2.BORDER_CONSTANT, value=WHITE)
-        image[p0[1]:p1[1], prev_x:prev_x + superimposed.shape[1]] = superimposed
-        cv2.putText(image, method, (prev_x, p0[1]), cv2.FONT_HERSHEY_SIMPLEX, 1, BLUE, 3)
-        return image
-    
+    def annotate(self, filename, image, rotated, annotations):
+        """
+        Renders the annotations of the page and writes it, or (headless) only records them, so that
+        the page can be rendered later on (see render_page)
+        """
+        if not self.headless:
+            self.write(filename, annotations.render(image))
+            return
+        key = ".".join(os.path.basename(filename).split(".")[:-1])
+        entry = { 'key': key, 'filename': filename, 'rotated': rotated, 'annotations': annotations.to_data() }
+        with self.results_mutex:
+            with open(self.annotations, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def render_page(self, entry):
+        image = self.read(entry['filename'])
+        if entry['rotated']:
+            image = cv2.rotate(image, cv2.ROTATE_180)
+        self.write(entry['filename'], Overlay.from_data(entry['annotations']).render(image))
+
+    def is_latest(self, filename, position):
+        """
+        Checks whether the page at the given scan position is the latest occurrence of its key
+        """
+        if self.latest is None or position is None:
+            return True
+        return self.latest.is_latest(".".join(os.path.basename(filename).split(".")[:-1]), position)
+
     def write(self, filename, image):
+        key = filename
         filename = os.path.join('tmp', os.path.basename(filename))
         filename = ".".join(filename.split(".")[:-1]) + ".jpg"
         # rescale to 72 dpi to save space
         image = cv2.resize(image, None, fx=72.0 / self.resolution, fy=72.0 / self.resolution, interpolation=cv2.INTER_AREA)
-        cv2.imwrite(filename, image, [cv2.IMWRITE_JPEG_QUALITY, self.compression])
-
+        if self.latest is None or self.position is None:
+            cv2.imwrite(filename, image, [cv2.IMWRITE_JPEG_QUALITY, self.compression])
+            return
+        _, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.compression])
+        # a page scanned twice is written only by its latest occurrence, even if corrected first
+        with self.latest.lock:
+            if self.is_latest(key, self.position):
+                with open(filename, 'wb') as f:
+                    f.write(data.tobytes())
 
-    def append_correction(self, student, page, detected_answers, correct_answers):
-        with TinyDB(f"{self.data_filename}.tmp") as db:
-            table = db.table('correction')
-            data = { 
-                "student_id": student, 
-                "page": page, 
-                "detected_answers": detected_answers,
-                "correct_answers": correct_answers
-            }
-            table.insert(data)
 
     @staticmethod
-    def circle_filled_area(binary, c):
-        area = 0
-        cx, cy = c[:2]
-        radius = c[2]
-        xbounds = (max(0, int(cx - radius)), min(binary.shape[1], int(cx + radius) + 1))
-        w = xbounds[1] - xbounds[0]
-        ybounds = (max(0, int(cy - radius)), min(binary.shape[0], int(cy + radius) + 1))
-        h = ybounds[1] - ybounds[0]
-        enclosing_box = binary[ybounds[0]:ybounds[1], xbounds[0]:xbounds[1]]
-        y, x = np.ogrid[-h // 2 : h // 2, -w // 2 : w // 2]
-        mask = x * x + y * y > radius * radius
-
-        return np.count_nonzero(np.ma.masked_array(enclosing_box, mask).ravel())
+    def circles_filled_area(integral, circles):
+        """
+        Counts the filled pixels within the bounding box of each circle (clipped to the image), 
+        all at once through the integral image of the binary map
+        """
+        if len(circles) == 0:
+            return np.zeros(0, dtype=int)
+        circles = np.array([c[:3] for c in circles], dtype=float)
+        height, width = integral.shape[0] - 1, integral.shape[1] - 1
+        cx, cy, radius = circles[:, 0], circles[:, 1], circles[:, 2]
+        x0 = np.clip(np.trunc(cx - radius).astype(int), 0, width)
+        x1 = np.clip(np.trunc(cx + radius).astype(int) + 1, x0, width)
+        y0 = np.clip(np.trunc(cy - radius).astype(int), 0, height)
+        y1 = np.clip(np.trunc(cy + radius).astype(int) + 1, y0, height)
+        return (integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]).astype(int)
 
     @staticmethod
-    def detect_circles_edges(roi, metadata, area_threshold=0.45):    
+    def detect_circles_edges(preprocessed, metadata, area_threshold=0.45):    
 
         # in order to detect the contours in the roi, a blur and an adaptive thresholding is used
-        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if len(roi.shape) > 2 else roi
-        gray = cv2.GaussianBlur(gray, (5, 5), 2)
-        binary_for_edges = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 11, 2)
-        # get the contours
-        contours, _ = cv2.findContours(binary_for_edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-        # get a more precise binary image for computing area
-        _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)
-        binary += binary_for_edges
+        # (the shared binary image is more precise for computing area)
+        contours, _ = cv2.findContours(preprocessed.adaptive(5), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
         # try to construct the circles
-        circles = []
-        empty_circles = []
+        candidates = []
         scaling = metadata['scaling']
         bubble_radius = np.max(np.dot(metadata['bsize'], scaling) / 2.0)
         # for each detcted contour
@@ -432,12 +879,13 @@ class Correct:
             if len(approx) >= 8:                        
                 (cx, cy), radius = cv2.minEnclosingCircle(contour)
                 if 0.75 * bubble_radius <= radius <= 1.8 * bubble_radius:
-                    if Correct.circle_filled_area(binary, (int(cx), int(cy), int(radius))) > area_threshold * bubble_radius * bubble_radius * math.pi:
-                        circles.append((int(cx), int(cy), int(radius)))
-                    else:
-                        empty_circles.append((int(cx), int(cy), int(radius)))
+                    candidates.append((int(cx), int(cy), int(radius)))
+        # the filled ones are the circles, the others are empty
+        filled = Correct.circles_filled_area(preprocessed.integral, candidates) > area_threshold * bubble_radius * bubble_radius * math.pi
+        circles = [c for c, f in zip(candidates, filled) if f]
+        empty_circles = [c for c, f in zip(candidates, filled) if not f]
         # sort circles according to the x component (leftmost first, topmost after)
-        return binary, circles, empty_circles
+        return circles, empty_circles
 
     @staticmethod
     def circle_intersection_area(c1, c2):
@@ -459,13 +907,14 @@ class Correct:
     @staticmethod 
     def highlight_circle(target, c, color, offset=5, **kwargs):
         if "shape" in kwargs and kwargs["shape"] == "rectangle":
-            return cv2.rectangle(target, tuple(np.array(c[:2]) - (c[2] + offset)), tuple(np.array(c[:2]) + (c[2] + offset)), color, 3)
+            target.rectangle(tuple(np.array(c[:2]) - (c[2] + offset)), tuple(np.array(c[:2]) + (c[2] + offset)), color, 3)
         else:
-            return cv2.circle(target, c[:2], c[2] + offset, color, 3)
+            target.circle(c[:2], c[2] + offset, color, 3)
 
     @staticmethod
-    def process_circles(roi, binary, circles, empty_circles, metadata, page_answers=None, offset=5, xdistance=1.25):                        
-        mask = np.ones((*roi.shape[:2], 3), np.uint8) * 255
+    def process_circles(preprocessed, circles, empty_circles, metadata, page_answers=None, offset=5, xdistance=1.25):                        
+        integral = preprocessed.integral
+        mask = Overlay(preprocessed.shape)
         # identify the reference_circles first, assuming the leftmost/topmost is the reference one
         circles = sorted(circles)
         pivot = circles[0]
@@ -476,27 +925,21 @@ class Correct:
         # all the other are the answer circles
         other_circles = [c for c in circles if abs(c[0] - pivot[0]) > pivot[2]]
         # highlight the reference circles
-        for c in reference_circles:
+        for c, filled_area in zip(reference_circles, Correct.circles_filled_area(integral, reference_circles) / reference_area):
             Correct.highlight_circle(mask, c, CYAN)
-            filled_area = Correct.circle_filled_area(binary, c) / reference_area
             #text = f"{filled_area:.0%}"
-            #cv2.putText(mask, text, tuple(np.array(c[:2]) - np.array([c[2], c[2] + 2 * offset])), 
+            #mask.putText(text, tuple(np.array(c[:2]) - np.array([c[2], c[2] + 2 * offset])), 
             #            cv2.FONT_HERSHEY_SIMPLEX, 0.8, CYAN, 3)
         # maintain the information as a mapping between the reference circle and all the
         # answer circles on the same row
         answer_circles = {c: [] for c in reference_circles}
-        # process the answer circles
-        for c in other_circles:
+        # process the answer circles and the empty ones (they are meaningful only for edge detection)
+        candidates = [tuple(list(c) + [True]) for c in other_circles] + [tuple(list(c) + [False]) for c in empty_circles]
+        if candidates:
             # find the closest reference circle, w.r.t. y coordinate
-            ydist = np.fromiter((abs(c[1] - rc[1]) for rc in reference_circles), int)
-            reference_circle = reference_circles[np.argmin(ydist)]
-            answer_circles[reference_circle].append(tuple(list(c) + [True]))
-        # and the empty ones (they are meaningful only for edge detection)
-        for c in empty_circles:
-            # find the closest reference circle, w.r.t. y coordinate
-            ydist = np.fromiter((abs(c[1] - rc[1]) for rc in reference_circles), int)
-            reference_circle = reference_circles[np.argmin(ydist)]
-            answer_circles[reference_circle].append(tuple(list(c) + [False]))
+            _, rows = cKDTree([[rc[1]] for rc in reference_circles]).query([[c[1]] for c in candidates])
+            for c, row in zip(candidates, rows):
+                answer_circles[reference_circles[row]].append(c)
         # now consider each reference circle from the topmost one down
         answer_circles = sorted(answer_circles.items(), key=lambda item: item[0][1])
         # check whether questions and the expected sequence of answers match
@@ -524,68 +967,63 @@ class Correct:
                 Correct.highlight_circle(mask, c, ORANGE, shape="rectangle")
             # TODO: assumption that the line of answers is almost horizontal, it could be detected
             #       another assumption is that the maximum number of answers is 10
-            phantom_circles = []
-            for j in range(1, 11):
-                # this is a phantom circle that should be present in the image
-                c = np.array(reference_circle[:2]) + [j * xdistance * 2 * reference_radius, 0]
-                c = tuple(list(c) + [reference_radius]) 
-                # check if the phantom circle is outside the roi image or there's nothing below the circle
-                # TODO: the first check is not working anymore, consider fixing it later
-                #if c[0] + c[2] > binary.shape[0] or Correct.circle_filled_area(binary, c) < 0.1 * reference_area:
-                if Correct.circle_filled_area(binary, c) < 0.1 * reference_area:
-                    break
-                phantom_circles.append(c)
+            # these are the phantom circles that should be present in the image
+            phantom_circles = [tuple(list(np.array(reference_circle[:2]) + [j * xdistance * 2 * reference_radius, 0]) + [reference_radius])
+                               for j in range(1, 11)]
+            # they stop at the first one that is outside the roi image or has nothing below
+            # TODO: the first check is not working anymore, consider fixing it later
+            #if c[0] + c[2] > binary.shape[0] or Correct.circle_filled_area(binary, c) < 0.1 * reference_area:
+            empty = np.flatnonzero(Correct.circles_filled_area(integral, phantom_circles) < 0.1 * reference_area)
+            if len(empty) > 0:
+                phantom_circles = phantom_circles[:empty[0]]
             
-            # let's check if the phantom circles have a detected counterpart
-            for a in given_answers:
-                distances = np.fromiter((np.linalg.norm(np.array(c[:2]) - np.array(a[:2])) for c in phantom_circles), float)
-                if len(distances) > 0:
-                    closer_phantom_circle = np.argmin(distances)
-                    if distances[closer_phantom_circle] < reference_radius:
-                        del phantom_circles[closer_phantom_circle]            
+            # let's check if the phantom circles have a detected counterpart (the closest one to each answer)
+            if phantom_circles and given_answers:
+                distances, closer_phantom_circles = cKDTree([c[:2] for c in phantom_circles]).query([a[:2] for a in given_answers])
+                matched = set(closer_phantom_circles[distances < reference_radius])
+                phantom_circles = [c for j, c in enumerate(phantom_circles) if j not in matched]
             for c in phantom_circles:
                 c = tuple(list(map(int, c)) + [False])
                 Correct.highlight_circle(mask, c, GRAY)
                 given_answers.append(c)                               
             given_answers = sorted(given_answers)
-            for j, c in enumerate(given_answers):
+            filled_areas = Correct.circles_filled_area(integral, given_answers) / reference_area
+            for j, (c, filled_area) in enumerate(zip(given_answers, filled_areas)):
                 r = chr(j + ord('A'))
                 all_res.add(r)
-                filled_area = Correct.circle_filled_area(binary, c) / reference_area
                 text = f"{filled_area:0>4.0%}"
-                cv2.putText(mask, text, tuple(np.array(c[:2]) - np.array([c[2], c[2] + 2 * offset])), 
+                mask.putText(text, tuple(np.array(c[:2]) - np.array([c[2], c[2] + 2 * offset])), 
                             cv2.FONT_HERSHEY_SIMPLEX, 0.5, MAGENTA, 2)
-                cv2.circle(mask, c[:2], c[2], alpha(YELLOW, 0.3), -1)
+                mask.circle(c[:2], c[2], alpha(YELLOW, 0.3), -1)
                 if c[3]:
                     answers_res.add(r)
                     if r in correct_res:
-                        cv2.circle(mask, c[:2], c[2], alpha(GREEN, 1.0), -1)
+                        mask.circle(c[:2], c[2], alpha(GREEN, 1.0), -1)
                     else:
-                        cv2.circle(mask, c[:2], c[2], alpha(RED, 1.0), -1)
+                        mask.circle(c[:2], c[2], alpha(RED, 1.0), -1)
                 else:
                     if r in correct_res:
-                        cv2.circle(mask, c[:2], c[2], alpha(ORANGE, 1.0), -1)
+                        mask.circle(c[:2], c[2], alpha(ORANGE, 1.0), -1)
             # check if there are missing answers on the paper-sheet
             missing_answers = correct_res - all_res
             if len(missing_answers) > 0:
                 click.secho(f"Warning: For question {i}/({metadata['student_id']}-{metadata['page']}), the correct {p.plural('answer', len(missing_answers))} {missing_answers} {p.plural_verb('was', len(missing_answers))} not printed on the sheet", fg="yellow")
                 ytop = round(reference_circle[1] - 1.3 * reference_circle[2])
                 ybottom = round(reference_circle[1] + 1.3 * reference_circle[2])
-                cv2.rectangle(mask, (0, ytop), (roi.shape[1], ybottom), RED, 7)
+                mask.rectangle((0, ytop), (preprocessed.shape[1], ybottom), RED, 7)
                 p = np.array(reference_circle[:2]) + [-reference_circle[2], -reference_circle[2] - 40]
-                cv2.putText(mask, f"Missing {missing_answers} found {all_res}", tuple(p), cv2.FONT_HERSHEY_SIMPLEX, 1, RED, 3)
+                mask.putText(f"Missing {missing_answers} found {all_res}", tuple(p), cv2.FONT_HERSHEY_SIMPLEX, 1, RED, 3)
             # write a text with the given answers and the correct ones close to each reference circle
             p = np.array(reference_circle[0:2]) + [-reference_circle[2], reference_circle[2] - 100]
             tmp = ("".join(sorted(a for a in answers_res)) if answers_res else "None")
             tmp += "/" + ("".join(sorted(a for a in correct_res)) if correct_res else "None")
-            cv2.putText(mask, tmp, tuple(p), cv2.FONT_HERSHEY_SIMPLEX, 1, MAGENTA, 3)
+            mask.putText(tmp, tuple(p), cv2.FONT_HERSHEY_SIMPLEX, 1, MAGENTA, 3)
             correction.append((answers_res, correct_res))
         return correction, mask
 
     @staticmethod
-    def detect_circles_blob(roi, metadata):
-        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if len(roi.shape) > 2 else roi
-        gray = cv2.GaussianBlur(gray, (9, 9), 2)
+    def detect_circles_blob(preprocessed, metadata):
+        gray = preprocessed.blur(9)
         
         params = cv2.SimpleBlobDetector_Params()
         scaling = metadata['scaling']
@@ -621,59 +1059,26 @@ class Correct:
             circles = list(map(lambda k: (int(k.pt[0]), int(k.pt[1]), int(bubble_radius)), keypoints))
         else:
             circles = []
-        binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                    cv2.THRESH_BINARY_INV, 11, 2)
-        binary += cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)[1]
         
-        return binary, circles, []
+        return circles, []
 
     @staticmethod
-    def detect_circles_laplacian(roi, metadata):
-        def round_up_to_odd(f):
-            return math.ceil(f) // 2 * 2 + 1 
-        
+    def detect_circles_laplacian(preprocessed, metadata):
         def collapse_identical_circles(candidates, radius, threshold=0.3):            
-            fusion = True
-            next_centers = set(candidates)
-            while fusion:
-                fusion = False
-                prev_centers = next_centers
-                next_centers = set()
-                done = set()
-                for c1 in prev_centers:  
-                    if c1 in done:
-                        continue              
-                    identical = []
-                    done.add(c1)
-                    for c2 in prev_centers - done:
-                        if np.linalg.norm(np.array(c1[:2]) - np.array(c2[:2])) < threshold * radius:
-                            identical.append(c2)                
-                    if identical:
-                        fusion = True
-                        for c in identical + [c1]:
-                            if c in next_centers:
-                                next_centers.remove(c)
-                            done.add(c)
-                        next_centers.add(tuple(np.mean(identical + [c1], axis=0)))
-                    else:
-                        next_centers.add(c1)
-            return next_centers                                                                   
+            # the groups of close centers are fused into their mean, until no centers are close
+            centers = np.unique(np.asarray(candidates, dtype=float).reshape(-1, 3), axis=0)
+            while len(centers) > 1:
+                pairs = cKDTree(centers[:, :2]).query_pairs(threshold * radius, output_type='ndarray')
+                if len(pairs) == 0:
+                    break
+                adjacency = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(centers), len(centers)))
+                groups, labels = connected_components(adjacency, directed=False)
+                centers = np.array([centers[labels == g].mean(axis=0) for g in range(groups)])
+            return list(map(tuple, centers))
 
-        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if len(roi.shape) > 2 else roi
-        gray = cv2.GaussianBlur(gray, (11, 11), 2)
-        
         s = np.max(np.dot(metadata['bsize'], metadata['scaling']) / 2.0)
-
-        s1 = s / 1.4142 # stretto
-        # some denoising
-        im1 = cv2.GaussianBlur(gray, (round_up_to_odd(1 + 5 * s1), round_up_to_odd(1 + 5 * s1)), s1)
-
-        s2 = s * 1.4142 #largo
-        # some denoising
-        im2 = cv2.GaussianBlur(gray, (round_up_to_odd(1 + 5 * s2), round_up_to_odd(1 + 5 * s2)), s2)
-
-        response = im2.astype(float) - im1.astype(float)  #largo - stretto
-        response = cv2.normalize(response, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8UC1)
+        # difference of gaussians (largo - stretto)
+        response = preprocessed.dog(s)
         
         y, x = np.ogrid[-s // 2 : s // 2, -s // 2 : s // 2]
         mask = x * x + y * y <= s * s    
@@ -690,17 +1095,12 @@ class Correct:
             (cx, cy), _ = cv2.minEnclosingCircle(contour)
             candidates.append((cx, cy, s))
         circles = list(map(lambda c: tuple(map(int, c)), collapse_identical_circles(candidates, s)))
-            
-        binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                    cv2.THRESH_BINARY_INV, 11, 2)
-        binary += cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)[1]    
         
-        return binary, circles, []
+        return circles, []
 
     @staticmethod
-    def detect_circles_hough(roi, metadata):
-        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if len(roi.shape) > 2 else roi
-        gray = cv2.GaussianBlur(gray, (9, 9), 2)
+    def detect_circles_hough(preprocessed, metadata):
+        gray = preprocessed.blur(9)
 
         scaling = metadata['scaling']
         bubble_radius = np.max(np.dot(metadata['bsize'], scaling) / 2.0)
@@ -723,17 +1123,9 @@ class Correct:
 
         candidates = list(map(tuple, np.round(candidates[0, :]).astype("int")))
 
-        binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                    cv2.THRESH_BINARY_INV, 11, 2)
-        binary += cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)[1]
-
-
         bubble_area = bubble_radius * bubble_radius * math.pi
-        circles, empty_circles = [], []
-        for c in candidates:
-            if Correct.circle_filled_area(binary, c) >= 0.7 * bubble_area:
-                circles.append(c)
-            else:
-                empty_circles.append(c)
+        filled = Correct.circles_filled_area(preprocessed.integral, candidates) >= 0.7 * bubble_area
+        circles = [c for c, f in zip(candidates, filled) if f]
+        empty_circles = [c for c, f in zip(candidates, filled) if not f]
         
-        return binary, circles, empty_circles
+        return circles, empty_circles
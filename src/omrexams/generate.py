@@ -151,6 +151,8 @@ class Generate:
             self.generate_task_done = mp.Condition(self.results_mutex)
             self.results = mp.Value('i', 0, lock=self.results_mutex)
             self.error = mp.Value('b', False, lock=self.results_mutex)
+            # the exam of each student is handed over to the parent, which stores all of them at once
+            self.exams_queue = mp.Queue()
             for i, student in enumerate(self.students):
                 self.generate_tasks_queue.put((i, student))
             for _ in range(mp.cpu_count()):
@@ -164,6 +166,10 @@ class Generate:
                 bar.update(self.results.value - prev)
                 prev = self.results.value
                 self.results_mutex.release()
+            # one (possibly missing) exam for each student, in the order of the students list
+            exams = sorted((self.exams_queue.get() for _ in self.students), key=lambda e: e[0])
+            with TinyDB(self.output_list_filename) as db:
+                db.table('exams').insert_multiple(data for _, data in exams if data is not None)
 
         click.secho('Collating PDF', fg='red', underline=True)
         pdf_files = sorted(glob.glob(os.path.join('tmp', '*.pdf')))
@@ -240,11 +246,10 @@ class Generate:
                 self.error.value = True
                 self.results_mutex.release()
             finally:
+                # hand over the exam to the parent
+                self.exams_queue.put((task, Generate.exam_data(student, questions, answers) if done else None))
                 self.results_mutex.acquire()
                 self.results.value += 1
-                # append to list of exams
-                if done:
-                    self.append_exam(student, questions, answers)
                 self.generate_task_done.notify()
                 self.results_mutex.release()
                 self.generate_tasks_queue.task_done()
@@ -406,6 +411,7 @@ class Generate:
                               dyslexia=self.config.get('dyslexia', False),
                               circled=self.config.get('choices', {}).get('circled', False),
                               usesf=self.config.get('choices', {}).get('usesf', False),
+                              qrcode_version=self.config['exam'].get('qrcode_version', 1),
                               basedir=os.path.realpath(self.questions_path)) as renderer:
             content = '---\n' + '\n---\n'.join(map(lambda q: q[2], questions)) + '\n---\n'
             if open_questions:
@@ -416,7 +422,8 @@ class Generate:
             overall_answers = list(code_answer(q['answers']) for q in renderer.questions)
             return document, tmp, overall_answers
     
-    def append_exam(self, student, questions, answers):  
+    @staticmethod
+    def exam_data(student, questions, answers):  
         data = { 
             "student_id": str(student[0]),
             "fullname": student[1],                        
@@ -425,10 +432,7 @@ class Generate:
         for q in questions:
             data['questions'].append(q)
         data['answers'] = answers
-        with TinyDB(self.output_list_filename) as db:
-#            import json
-#            print(json.dumps(data))
-            db.table('exams').insert(data)
+        return data
 
     def generate_test(self):
         rules = self.load_rules()
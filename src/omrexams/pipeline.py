@@ -0,0 +1,80 @@
+import multiprocessing as mp
+import click
+import logging
+from . sort import Sort
+from . correct import Correct
+
+logger = logging.getLogger("omrexams")
+
+class LatestPages:
+    """
+    Registry of the scan position of the latest occurrence of each page (student_id-page), shared by the
+    sorting and the correcting processes: when a page has been scanned twice only the last one is corrected,
+    as it happens when the sorted pages are written to a directory
+    """
+    def __init__(self):
+        self.manager = mp.Manager()
+        self.positions = self.manager.dict()
+        self.lock = mp.Lock()
+
+    def claim(self, key, position):
+        """
+        Registers an occurrence of a page, it returns False if a later one is already registered
+        """
+        with self.lock:
+            latest = self.positions.get(key)
+            if latest is not None and tuple(latest) > tuple(position):
+                return False
+            self.positions[key] = tuple(position)
+            return True
+
+    def is_latest(self, key, position):
+        return self.positions.get(key) == tuple(position)
+
+    def shutdown(self):
+        self.manager.shutdown()
+
+class Pipeline:
+    """
+    This class fuses the sorting and the correction of the scanned exams: each page decoded
+    from the scanned PDFs is handed over to the correction workers as soon as it is available,
+    without storing the sorted pages on disk.
+    """
+    def __init__(self, scanned, corrected, data_filename, resolution, compression, paper="A4", queue_size=None, preview=None, threads=None, template=True, agreement=2, detectors=None, per_student=None, combined=True, index=None):
+        self.resolution = resolution
+        self.paper = paper
+        self.preview = preview
+        # the pages queue is bounded, so that sorting does not run too far ahead of correction
+        self.queue_size = queue_size or 2 * mp.cpu_count()
+        self.sorter = Sort(scanned, None, None)
+        # the cpus are split between sorting and correcting, which run at the same time
+        cpu = mp.cpu_count()
+        self.sorter.processes = max(1, cpu // 2)
+        self.corrector = Correct(None, corrected, data_filename, resolution, compression, threads=threads, template=template, agreement=agreement, detectors=detectors,
+                                 per_student=per_student, combined=combined, index=index)
+        self.corrector.cpu = max(1, cpu - self.sorter.processes)
+
+    def process(self):
+        pages_queue = mp.JoinableQueue(self.queue_size)
+        self.sorter.pages_queue = pages_queue
+        latest = LatestPages()
+        self.sorter.latest = self.corrector.latest = latest
+        pages = self.sorter.prepare(self.resolution, self.paper, self.preview)
+        self.corrector.prepare(pages_queue, pages)
+        pool = mp.Pool(self.corrector.processes, self.corrector.worker_main)
+        pool.close()
+        click.secho(f"Sorting and correcting {pages} scanned pages", fg='red', underline=True)
+        with click.progressbar(length=pages, label='Sorting and correcting',
+                               bar_template='%(label)s |%(bar)s| %(info)s',
+                               fill_char=click.style(u'█', fg='cyan'),
+                               empty_char=' ', show_pos=True) as bar:
+            self.sorter.run(pages, bar)
+        self.sorter.retry()
+        logger.info('Waiting for the pending corrections')
+        pages_queue.join()
+        for _ in range(self.corrector.processes):
+            pages_queue.put(None)
+        self.sorter.finish()
+        click.secho('Correction finished', fg='red', underline=True)
+        self.corrector.collect()
+        latest.shutdown()
@@ -1,5 +1,6 @@
 from pypdf import PdfReader, PdfWriter
 from . utils import qrdecoder
+from . utils.page_store import PageStore, page_stamp, append_metadata
 from wand.image import Image
 from wand.color import Color
 import io
@@ -10,79 +11,153 @@ import click
 import cv2
 import numpy as np
 import math
+import img2pdf
 from . utils.colors import *
 from tinydb import TinyDB, Query
-import copy
-from shutil import rmtree
 import logging
+import json
+import hashlib
+from functools import lru_cache
+from itertools import groupby
 
 logger = logging.getLogger("omrexams")
 
+# content stream operators allowed in a page consisting of a single scanned image
+IMAGE_ONLY_OPERATORS = {b'q', b'Q', b'cm', b'Do'}
+# clockwise /Rotate page attribute mapped to the corresponding openCV rotations
+ROTATIONS = { 90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE }
+# number of parsed pdf files kept open by each worker
+READER_CACHE_SIZE = 4
+# number of page ranges each worker is expected to get (the smaller, the longer the ranges)
+PAGE_RANGES_PER_WORKER = 4
+# name of the manifest of the already processed pages within the sorted directory
+MANIFEST_NAME = 'manifest.jsonl'
+# the pages not decoded by the first pass are eventually rasterized again at a higher resolution
+RETRY_RESOLUTION_FACTOR = 2
+
+@lru_cache(maxsize=READER_CACHE_SIZE)
+def open_pdf(filename):
+    """
+    Parses a pdf file only once per process, the reader is kept for the subsequent pages
+    """
+    return PdfReader(filename)
+
 class Sort:
     """
     This class is responsible of dispatching the scanned exams from a PDF into
     a set of files, one for each single student, to be further processed later.
     """
-    def __init__(self, scanned, sorted, doublecheck):
+    def __init__(self, scanned, sorted, doublecheck, pages_queue=None, container=None):
         self.scanned = scanned
         self.sorted = sorted
         self.offset = 10 # cropping offset, TODO: become a parameter
         self.doublecheck = doublecheck
+        # when a queue is given, the sorted pages are forwarded to it instead of being written
+        self.pages_queue = pages_queue
+        # when a codec is given, the sorted pages are stored in a single container file
+        self.container = container
+        self.store = None
+        self.manifest = None
+        # number of worker processes (all the cpus by default)
+        self.processes = None
+        # registry of the latest occurrence of each page, when the sorted pages are forwarded (see the Pipeline class)
+        self.latest = None
 
-    def sort(self, resolution, paper="A4"):
+    def sort(self, resolution, paper="A4", clean=False, preview=None):
         if not os.path.exists(self.sorted):
             click.secho(f'Creating directory {self.sorted}')
             os.mkdir(self.sorted)
-        else: # clean previous content
+        elif clean: # clean previous content
             click.secho(f'Cleaning directory {self.sorted}')
             for f in glob.glob(os.path.join(self.sorted, '*')):
                 os.remove(f)
+        if self.container is not None:
+            self.store = PageStore.open(self.sorted, self.container)
+        # the manifest keeps track of the processed pages, so that only new pages are sorted again
+        self.manifest = os.path.join(self.sorted, MANIFEST_NAME)
+        pages = self.prepare(resolution, paper, preview)
+        with click.progressbar(length=pages, label='Dispatching scanned exams',
+                               bar_template='%(label)s |%(bar)s| %(info)s',
+                               fill_char=click.style(u'█', fg='cyan'),
+                               empty_char=' ', show_pos=True) as bar:
+            self.run(pages, bar)
+        self.retry()
+        self.finish()
+        click.secho('Finished', fg='red', underline=True)
+
+    def prepare(self, resolution, paper="A4", preview=None):
+        """
+        Creates the shared structures and enqueues the pages of the scanned files,
+        it returns the number of pages to be processed.
+        With a preview resolution, the qrcodes are decoded on a lower resolution image and 
+        only the pages with an exam are then rasterized at the full resolution
+        """
         self.resolution = resolution
+        self.paper = paper
+        self.preview = preview if preview and preview < resolution else None
         self.offset = int(1.0 / (2.54 / resolution))
         self.tasks_queue = mp.JoinableQueue()
         self.results_mutex = mp.RLock()
         self.task_done = mp.Condition(self.results_mutex)
         self.results = mp.Value('i', 0, lock=self.results_mutex)   
         self.page_leftovers = mp.Queue()
+        # pages not decoded by the first pass, to be retried by the second stage
+        self.retries = mp.Queue()
+        self.retried = mp.Value('i', 0, lock=self.results_mutex)
+        self.decoding_statistics = qrdecoder.shared_statistics(self.results_mutex)
 
         pages = 0
+        skipped = 0
+        self.hashes = {}
+        processed = self.load_manifest()
 
-        if paper == "A4":
-            for fn in self.scanned:
-                with open(fn, 'rb') as f:
-                    pdf_file = PdfReader(f)
-                    for p in range(len(pdf_file.pages)):
-                        self.tasks_queue.put((fn, p))
-                    pages += len(pdf_file.pages)
-        else:
-            if not os.path.exists('split_tmp'):
-                click.secho(f'Creating directory {"split_tmp"}')
-                os.mkdir('split_tmp')
-
-            for fn in self.scanned:
-                with open(fn, 'rb') as f, open(os.path.join('split_tmp', os.path.basename(fn)), 'wb') as sf:
-                    pdf_file = Sort.split_pages(PdfReader(f))
-                    merger = PdfWriter()
-                    merger.append(pdf_file)
-                    merger.write(sf)
-                    for p in range(len(pdf_file.pages)):
-                        self.tasks_queue.put((os.path.join('split_tmp', os.path.basename(fn)), p))
-                    pages += len(pdf_file.pages)
+        # A3 sheets are split into their two A4 halves only after being rasterized
+        for fn in self.scanned:
+            with open(fn, 'rb') as f:
+                pdf_file = PdfReader(f)
+                if self.manifest is not None:
+                    self.hashes[fn] = Sort.file_hash(fn)
+                remaining = [p for p in range(len(pdf_file.pages)) if not self.is_processed(processed, fn, p)]
+                self.dispatch(fn, remaining)
+                pages += len(remaining)
+                skipped += len(pdf_file.pages) - len(remaining)
+        if skipped:
+            click.secho(f'Skipping {skipped} pages already sorted in a previous run', fg='cyan')
+        return pages
 
-        with click.progressbar(length=pages, label='Dispatching scanned exams',
+    def run(self, pages, bar, worker=None):
+        processes = self.processes or mp.cpu_count()
+        for _ in range(processes):
+            self.tasks_queue.put((None, None, None))
+        self.pool = mp.Pool(processes, worker or self.worker_main)
+        self.pool.close()
+        start = prev = self.results.value
+        # pages are dispatched in ranges, therefore wait for each single page to be processed
+        while prev < start + pages:
+            with self.results_mutex:
+                self.task_done.wait_for(lambda: prev < self.results.value)
+                bar.update(self.results.value - prev)
+                prev = self.results.value
+
+    def retry(self):
+        """
+        Second stage, the pages not decoded by the (fast) first pass are decoded again with an escalating effort
+        """
+        retries = [self.retries.get() for _ in range(self.retried.value)]
+        if not retries:
+            return
+        # the workers of the first pass should have left the tasks queue before reusing it
+        self.pool.join()
+        click.secho(f"Retrying {len(retries)} pages not decoded by the first pass", fg='red', underline=True)
+        for task in retries:
+            self.tasks_queue.put(task)
+        with click.progressbar(length=len(retries), label='Retrying undecoded pages',
                                bar_template='%(label)s |%(bar)s| %(info)s',
                                fill_char=click.style(u'█', fg='cyan'),
                                empty_char=' ', show_pos=True) as bar:
-            for _ in range(mp.cpu_count()):
-                self.tasks_queue.put((None, None))
-            pool = mp.Pool(mp.cpu_count(), self.worker_main)
-            pool.close()
-            prev = 0
-            while not self.tasks_queue.empty():
-                with self.results_mutex:
-                    self.task_done.wait_for(lambda: prev <= self.results.value)
-                    bar.update(self.results.value - prev)
-                    prev = self.results.value
+            self.run(len(retries), bar, self.retry_main)
+
+    def finish(self):
         with self.results_mutex:
             if not self.page_leftovers.empty():
                 click.secho('There are page leftovers, merging them', fg='red', err=True)
@@ -92,121 +167,353 @@ class Sort:
                     dst_pdf.append(p)
                 with open('leftovers.pdf', 'wb') as f:
                     dst_pdf.write(f)
-        if paper == "A3":           
-            rmtree("split_tmp")
-        click.secho('Finished', fg='red', underline=True)
+        table = qrdecoder.statistics_table(self.decoding_statistics)
+        if table:
+            click.secho('Qrcode decoding statistics', fg='green')
+            click.echo(table)
+        if self.store is not None:
+            self.store.close()
+
+    def dispatch(self, filename, pages):
+        """
+        Enqueues the given pages of a file as contiguous ranges, so that each worker 
+        handles consecutive pages of the same (already parsed) file
+        """
+        chunk = max(1, math.ceil(len(pages) / (PAGE_RANGES_PER_WORKER * (self.processes or mp.cpu_count()))))
+        # consecutive pages have the same difference with their position in the list
+        for _, run in groupby(enumerate(pages), lambda item: item[1] - item[0]):
+            run = [p for _, p in run]
+            for first in range(0, len(run), chunk):
+                self.tasks_queue.put((filename, run[first], run[min(first + chunk, len(run)) - 1] + 1))
+
+    @staticmethod
+    def file_hash(filename):
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def load_manifest(self):
+        """
+        Reads the manifest of the previous runs, the last entry of each image wins
+        """
+        processed = {}
+        if self.manifest is None or not os.path.exists(self.manifest):
+            return processed
+        with open(self.manifest) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # possibly a line truncated by an interrupted run
+                    continue
+                processed[(entry['hash'], entry['page'], entry['half'])] = entry
+        return processed
+
+    def is_processed(self, processed, filename, page):
+        if self.manifest is None:
+            return False
+        for half in range(1 if self.paper == "A4" else 2):
+            entry = processed.get((self.hashes[filename], page, half))
+            if entry is None or entry['status'] == 'failed':
+                return False
+            if entry['status'] == 'sorted' and not self.is_stored(entry['output']):
+                return False
+        return True
+
+    def is_stored(self, output):
+        if self.store is not None:
+            return output in self.store.index
+        return os.path.exists(os.path.join(self.sorted, f"{output}.png"))
+
+    def record(self, filename, page, half, status, metadata):
+        """
+        Appends the outcome of an image to the manifest
+        """
+        if self.manifest is None:
+            return
+        entry = { 'hash': self.hashes[filename], 'page': page, 'half': half, 'status': status }
+        if metadata:
+            entry.update({ 'student_id': metadata['student_id'], 'exam_page': metadata['page'], 'output': Sort.key(metadata) })
+        with self.results_mutex:
+            with open(self.manifest, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
 
     def worker_main(self):                        
         while True:
-            filename, page = self.tasks_queue.get()
+            filename, first, last = self.tasks_queue.get()
             if filename is None:
                 break
+            for page in range(first, last):
+                try:
+                    full_images = lru_cache(maxsize=1)(lambda: [image for image, _, _ in self.load(filename, page)])
+                    for half, (image, description, _) in enumerate(self.load(filename, page, self.preview)):
+                        try:
+                            if self.preview is None:
+                                decode = Sort.fast_decode
+                            else:
+                                decode = Sort.refine(lambda half=half: full_images()[half])
+                            metadata = self.process(image, description, decode, position=self.position(filename, page, half))
+                        except Exception as e:
+                            # the page is left to the second stage
+                            logger.debug(str(e))
+                            with self.results_mutex:
+                                self.retries.put((filename, page, half))
+                                self.retried.value += 1
+                            continue
+                        self.checked(filename, page, half, metadata)
+                except Exception as e:
+                    print("\n", f"Error loading file {filename}, page {page + 1} \n{str(e)}")
+                finally:
+                    with self.results_mutex:
+                        qrdecoder.backends.collect(self.decoding_statistics)
+                        self.results.value += 1
+                        self.task_done.notify()
+            self.tasks_queue.task_done()
+
+    def retry_main(self):
+        while True:
+            filename, page, half = self.tasks_queue.get()
+            if filename is None:
+                break
+            metadata = None
             try:
-                metadata = self.process(filename, page)
-                if metadata and self.doublecheck is not None:                    
-                    with TinyDB(self.doublecheck) as db:
-                        Exam = Query()
-                        table = db.table('exams')
-                        result = table.get(Exam.student_id == str(metadata['student_id']))
-                        if not result: 
-                            raise RuntimeError(f"Error double checking: student {metadata['student_id']} is not present in the data file")
-                        answers = metadata['correct']
-                        if result['answers'] != answers:                    
-                            raise RuntimeError(f"Expected correct answers for student {metadata['student_id']} do not match\ncoded: {answers}/{metadata['correct']}\nexpected: {result[0]['answers']}")
+                image, description, leftover = list(self.load(filename, page))[half]
+                hires = lambda: list(self.load(filename, page, self.resolution * RETRY_RESOLUTION_FACTOR))[half][0]
+                metadata = self.process(image, description, self.escalate(hires), leftover, self.position(filename, page, half))
+                self.checked(filename, page, half, metadata)
             except Exception as e:
                 print("\n", str(e))
+                self.record(filename, page, half, 'failed', metadata)
             finally:
                 with self.results_mutex:
+                    qrdecoder.backends.collect(self.decoding_statistics)
                     self.results.value += 1
                     self.task_done.notify()
-                    self.tasks_queue.task_done()
+            self.tasks_queue.task_done()
+
+    def checked(self, filename, page, half, metadata):
+        """
+        Records a decoded image, possibly double checking its content
+        """
+        try:
+            if metadata and self.doublecheck is not None:                    
+                self.double_check(metadata)
+        except Exception as e:
+            print("\n", str(e))
+        finally:
+            self.record(filename, page, half, 'sorted' if metadata else 'blank', metadata)
 
-    def process(self, filename, page):
-        dst_pdf = PdfWriter()
-        with open(filename, 'rb') as f:
-            current_page = PdfReader(f).pages[page]
-            dst_pdf.add_page(current_page)
-            pdf_bytes = io.BytesIO()
-            dst_pdf.write(pdf_bytes)
-            pdf_bytes.seek(0)
-        with Image(file=pdf_bytes, resolution=self.resolution) as img:
-            img.background_color = Color('white')
-            img.alpha_channel = 'remove'
-            img_buffer = np.asarray(bytearray(img.make_blob('bmp')), dtype=np.uint8)
-            image = cv2.imdecode(img_buffer, cv2.IMREAD_GRAYSCALE)   
-            try:
-                metadata = qrdecoder.decode(image)                    
-                if metadata is None:
-                    return None                    
-                if metadata.get('rotated', False):
-                    image = cv2.rotate(image, cv2.ROTATE_180)
-                # perform a rotation and image cropping to the qrcodes
-                tl = metadata['top_left_rect'][0]
-                br = metadata['bottom_right_rect'][2]
-                width, height = br - tl
-                rotation = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
-                # FIXME: currently the rotation is not working properly, possibly because the stored precision is not enough
-                if False and metadata.get('qrheight') is not None and metadata.get('qrwidth') is not None:
-                    detected_diag_angle = math.atan(height / width) * 360 / (2 * math.pi) 
-                    expected_diag_angle = math.atan(metadata['qrheight'] / metadata['qrwidth']) * 360 / (2 * math.pi)
-                    if not np.isclose(detected_diag_angle, expected_diag_angle):
-                        logger.debug(f"Correcting rotation by {detected_diag_angle - expected_diag_angle} degrees")
-                        rotation = cv2.getRotationMatrix2D(tuple(map(int, tl)),
-                            detected_diag_angle - expected_diag_angle, 1.0)          
-                rows, cols = image.shape[:2]
-                image = cv2.warpAffine(image, rotation, (cols, rows), borderValue=WHITE)
-                # the image could be flipped, therefore here we restore the right qrcode order
-                cv2.imwrite(os.path.join(self.sorted, f'{metadata["student_id"]}-{metadata["page"]}.png'), image)
-                return metadata
-            except Exception as e:        
-                with self.results_mutex:
-                    pdf_bytes.seek(0)                    
-                    self.page_leftovers.put(pdf_bytes.getvalue())        
-                raise RuntimeError(f"Error processing file {filename}, page {page + 1} \n{str(e)}")        
-            
     @staticmethod
-    def split_pages(reader):
-        writer = PdfWriter()
+    def fast_decode(image):
+        return image, qrdecoder.decode(image, fast=True)
 
-        for i in range(len(reader.pages)):
-            p = copy.copy(reader.pages[i])
-            q = copy.copy(reader.pages[i])
+    @staticmethod
+    def refine(full):
+        """
+        Returns a decoding function working on the preview image, the (lazy) full resolution image
+        is loaded only for the pages with an exam, and the qrcode positions are rescaled accordingly
+        """
+        def decode(preview):
+            metadata = qrdecoder.decode(preview, fast=True)
+            if metadata is None:
+                return preview, None
+            image = full()
+            return image, qrdecoder.rescale(metadata, image.shape[1] / preview.shape[1])
+        return decode
+
+    def escalate(self, hires):
+        """
+        Returns a decoding function trying, in order, all the decoding libraries, the enhanced image, 
+        a higher resolution rasterization and the sideways rotations of the page
+        """
+        def decode(image):
+            stages = [
+                ('all libraries', lambda: (image, qrdecoder.decode(image))),
+                ('enhanced image', lambda: (image, qrdecoder.decode(qrdecoder.prepare_image_for_decoding(image)))),
+                ('higher resolution', lambda: (image, qrdecoder.rescale(qrdecoder.decode(hires()), 1.0 / RETRY_RESOLUTION_FACTOR)))
+            ] + [
+                (f'rotation {angle}', lambda r=rotation: (cv2.rotate(image, r), qrdecoder.decode(cv2.rotate(image, r))))
+                for angle, rotation in ROTATIONS.items() if angle != 180
+            ]
+            error = None
+            for stage, attempt in stages:
+                try:
+                    result = attempt()
+                    # a blank result at this stage means that the qrcodes have not been found
+                    if result[1] is not None:
+                        logger.info(f"Page decoded by {stage}")
+                        return result
+                except Exception as e:
+                    error = e
+                    logger.debug(f"Decoding by {stage} failed: {e}")
+            raise RuntimeError(f"Cannot find qrcodes in page ({error})")
+        return decode
 
-            p.mediabox = copy.copy(p.cropbox)
-            q.mediabox = copy.copy(p.cropbox)
+    def double_check(self, metadata):
+        with TinyDB(self.doublecheck) as db:
+            Exam = Query()
+            table = db.table('exams')
+            result = table.get(Exam.student_id == str(metadata['student_id']))
+            if not result: 
+                raise RuntimeError(f"Error double checking: student {metadata['student_id']} is not present in the data file")
+            answers = metadata['correct']
+            if result['answers'] != answers:                    
+                raise RuntimeError(f"Expected correct answers for student {metadata['student_id']} do not match\ncoded: {answers}/{metadata['correct']}\nexpected: {result['answers']}")
 
-            x1, x2 = tuple(map(math.floor, p.mediabox.lower_left))
-            x3, x4 = tuple(map(math.floor, p.mediabox.upper_right))
+    def load(self, filename, page, resolution=None):
+        """
+        Generates the images of a scanned page, together with their description and a function
+        returning the pdf page to be stored among the leftovers in case of failure
+        """
+        resolution = resolution or self.resolution
+        current_page = open_pdf(filename).pages[page]
+        # scanners usually produce image-only pages, whose image can be decoded directly
+        image = Sort.extract_image(current_page, resolution)
+        if image is None:
+            image = Sort.rasterize(Sort.page_bytes(current_page), resolution)
+        if self.paper == "A4":
+            yield image, f"file {filename}, page {page + 1}", lambda: Sort.page_bytes(current_page).getvalue()
+        else:
+            # each A3 sheet is rasterized once and then split into its two halves
+            for i, half in enumerate(Sort.split_image(image)):
+                yield half, f"file {filename}, page {page + 1}, half {i + 1}", lambda half=half: Sort.image_bytes(half, self.resolution)
 
-            if x3 - x1 > x4 - x2:
-                # horizontal
-                m = x1 + math.floor((x3 - x1) / 2)
-                q.mediabox.upper_right = (m, x4)
-                q.mediabox.lower_left = (x1, x2)
+    def position(self, filename, page, half):
+        """
+        Position of an image within the scanned files, the later one wins when a page has been scanned twice
+        """
+        return (self.scanned.index(filename), page, half)
 
-                p.mediabox.upper_right = (x3, x4)
-                p.mediabox.lower_left = (m, x2)
+    def process(self, image, description, decode, leftover=None, position=None):
+        try:
+            image, metadata = decode(image)
+            if metadata is None:
+                return None                    
+            if metadata.get('rotated', False):
+                image = cv2.rotate(image, cv2.ROTATE_180)
+            # perform a rotation and image cropping to the qrcodes
+            tl = metadata['top_left_rect'][0]
+            br = metadata['bottom_right_rect'][2]
+            width, height = br - tl
+            rotation = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+            # FIXME: currently the rotation is not working properly, possibly because the stored precision is not enough
+            if False and metadata.get('qrheight') is not None and metadata.get('qrwidth') is not None:
+                detected_diag_angle = math.atan(height / width) * 360 / (2 * math.pi) 
+                expected_diag_angle = math.atan(metadata['qrheight'] / metadata['qrwidth']) * 360 / (2 * math.pi)
+                if not np.isclose(detected_diag_angle, expected_diag_angle):
+                    logger.debug(f"Correcting rotation by {detected_diag_angle - expected_diag_angle} degrees")
+                    rotation = cv2.getRotationMatrix2D(tuple(map(int, tl)),
+                        detected_diag_angle - expected_diag_angle, 1.0)          
+            rows, cols = image.shape[:2]
+            image = cv2.warpAffine(image, rotation, (cols, rows), borderValue=WHITE)
+            # the image could be flipped, therefore here we restore the right qrcode order
+            if self.pages_queue is not None:
+                # a page already forwarded from a later position of the scans supersedes this one
+                if self.latest is None or self.latest.claim(Sort.key(metadata), position):
+                    self.pages_queue.put((f'{Sort.key(metadata)}.png', image, metadata, position))
+                else:
+                    logger.warning(f"Page {Sort.key(metadata)} scanned twice, only the last one is corrected")
             else:
-                # vertical
-                m = x2 + math.floor((x4 - x2) / 2)
-                p.mediabox.upper_right = (x3, x4)
-                p.mediabox.lower_left = (x1, m)
+                if self.store is not None:
+                    stamp = ['container', self.store.append(Sort.key(metadata), image, self.results_mutex)]
+                else:
+                    cv2.imwrite(os.path.join(self.sorted, f'{Sort.key(metadata)}.png'), image)
+                    stamp = page_stamp(self.sorted, Sort.key(metadata))
+                # the metadata are stored as well, so that the correction does not need to decode the page again
+                append_metadata(self.sorted, Sort.key(metadata), stamp, metadata, self.results_mutex)
+            return metadata
+        except Exception as e:        
+            if leftover is not None:
+                with self.results_mutex:
+                    self.page_leftovers.put(leftover())        
+            raise RuntimeError(f"Error processing {description} \n{str(e)}")        
+        
+    @staticmethod
+    def key(metadata):
+        return f'{metadata["student_id"]}-{metadata["page"]}'
 
-                q.mediabox.upper_right = (x3, m)
-                q.mediabox.lower_left = (x1, x2)
+    @staticmethod
+    def page_bytes(page):
+        dst_pdf = PdfWriter()
+        dst_pdf.add_page(page)
+        pdf_bytes = io.BytesIO()
+        dst_pdf.write(pdf_bytes)
+        pdf_bytes.seek(0)
+        return pdf_bytes
 
-            p.artbox = p.mediabox
-            p.bleedbox = p.mediabox
-            p.cropbox = p.mediabox
+    @staticmethod
+    def rasterize(pdf_bytes, resolution):
+        with Image(file=pdf_bytes, resolution=resolution) as img:
+            img.background_color = Color('white')
+            img.alpha_channel = 'remove'
+            img_buffer = np.asarray(bytearray(img.make_blob('bmp')), dtype=np.uint8)
+            return cv2.imdecode(img_buffer, cv2.IMREAD_GRAYSCALE)
+
+    @staticmethod
+    def extract_image(page, resolution):
+        """
+        Decodes the image of an image-only page (i.e., a page whose content only draws one image
+        covering the whole page) and scales it to the given resolution.
+        It returns None for vector or mixed pages, which should be rasterized instead.
+        """
+        try:
+            contents = page.get_contents()
+            if contents is None:
+                return None
+            operations = contents.operations
+            if any(operator not in IMAGE_ONLY_OPERATORS for _, operator in operations):
+                return None
+            transformations = [operands for operands, operator in operations if operator == b'cm']
+            xobjects = page['/Resources'].get('/XObject', {})
+            xobjects = [xobject.get_object() for xobject in xobjects.values()]
+            if len(transformations) != 1 or len(xobjects) != 1:
+                return None
+            xobject = xobjects[0]
+            if xobject.get('/Subtype') != '/Image' or '/SMask' in xobject or '/Mask' in xobject:
+                return None
+            # the image should be drawn (unrotated) over the whole page
+            box = page.cropbox
+            a, b, c, d, e, f = map(float, transformations[0])
+            if not (np.isclose(b, 0) and np.isclose(c, 0) and 
+                    np.isclose(a, float(box.width), atol=1.0) and np.isclose(d, float(box.height), atol=1.0) and 
+                    np.isclose(e, float(box.left), atol=1.0) and np.isclose(f, float(box.bottom), atol=1.0)):
+                return None
+            width = round(float(box.width) / 72.0 * resolution)
+            height = round(float(box.height) / 72.0 * resolution)
+            pil_image = page.images[0].image
+            # jpeg images are directly decoded at a reduced scale when a lower resolution is requested
+            pil_image.draft('L', (width, height))
+            image = np.asarray(pil_image.convert('L'))
+        except Exception as e:
+            logger.debug(f"Cannot extract the page image, falling back to rasterization: {e}")
+            return None
+        if (width, height) != (image.shape[1], image.shape[0]):
+            interpolation = cv2.INTER_AREA if width < image.shape[1] else cv2.INTER_CUBIC
+            image = cv2.resize(image, (width, height), interpolation=interpolation)
+        rotation = page.rotation % 360
+        if rotation:
+            image = cv2.rotate(image, ROTATIONS[rotation])
+        return image
 
-            q.artbox = q.mediabox
-            q.bleedbox = q.mediabox
-            q.cropbox = q.mediabox
 
-            writer.add_page(q)
-            writer.add_page(p)
+    @staticmethod
+    def image_bytes(image, resolution):
+        _, data = cv2.imencode('.png', image)
+        return img2pdf.convert(data.tobytes(), layout_fun=img2pdf.get_fixed_dpi_layout_fun((resolution, resolution)))
 
-        buf = io.BytesIO()
-        writer.write(buf)
-        buf.seek(0)
-        return PdfReader(buf)
+    @staticmethod
+    def split_image(image):
+        """
+        Splits the image of an A3 sheet into its two halves, in the same order the pages 
+        have on the sheet (left/right for landscape sheets, bottom/top for portrait ones)
+        """
+        height, width = image.shape[:2]
+        if width > height:
+            # horizontal
+            m = width // 2
+            return np.ascontiguousarray(image[:, :m]), np.ascontiguousarray(image[:, m:])
+        else:
+            # vertical
+            m = height // 2
+            return image[m:, :], image[:m, :]
@@ -1,6 +1,7 @@
-from itertools import cycle
+from itertools import cycle, repeat
 from string import ascii_lowercase
 from binascii import a2b_base64, b2a_base64
+from base64 import b32encode, b32decode
 
 def caesar_shift(text, places):
     def substitute(char):
@@ -96,3 +97,33 @@ def binary_decrypt(solutions, key):
     return questions
 
 
+
+def compact_encrypt(solutions, key=None):
+    """
+    Compact (qrcode alphanumeric) encoding of the solutions: one byte per question, possibly xored 
+    with the key, in base32 without padding; the first character tells whether it is encrypted
+    """
+    if key is not None and type(key) is not str:
+        key = str(key)
+    # transform the key in sequence of bytes (taking only the least significant byte)
+    mask = (1 << 8) - 1
+    key_generator = cycle(ord(c) & mask for c in key) if key else repeat(0)
+    data = bytearray()
+    for i, text in enumerate(solutions):
+        q = 0b0
+        for c in text:
+            b = ord(c.lower()) - ord('a')
+            assert b < 8, f"Answer {c.lower()} out of range for question {i + 1} (limited to max 8, i.e., up to H)"
+            q |= (1 << b)
+        data.append(q ^ next(key_generator))
+    return ('E' if key else 'P') + b32encode(bytes(data)).decode('ascii').rstrip('=')
+
+def compact_decrypt(solutions, key):
+    if type(key) is not str:
+        key = str(key)
+    mask = (1 << 8) - 1
+    key_generator = cycle(ord(c) & mask for c in key) if solutions[0] == 'E' else repeat(0)
+    data = solutions[1:]
+    data = b32decode(data + '=' * (-len(data) % 8))
+    data = [q ^ k for q, k in zip(data, key_generator)]
+    return ["".join(chr(digit + ord('a')) for digit in range(8) if q & (1 << digit)) for q in data]
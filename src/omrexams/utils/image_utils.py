@@ -1,5 +1,7 @@
 import numpy as np
 import cv2
+import math
+import threading
 
 def order_points(pts):
         # initialize a list of coordinates that will be ordered
@@ -24,6 +26,72 @@ def order_points(pts):
         # return the ordered coordinates
         return rect
 
+def round_up_to_odd(f):
+    return math.ceil(f) // 2 * 2 + 1 
+
+class RoiPreprocessing:
+    """
+    Preprocessing of a roi shared by the circle detectors: the grayscale image, the blurs, the binary
+    maps and the difference of gaussians are computed lazily, only once each, also when the detectors
+    run in concurrent threads.
+    """
+    # blur kernel size of the binary map used for measuring the filled area of the circles
+    BINARY_BLUR = 9
+
+    def __init__(self, roi):
+        self.roi = roi
+        self.shape = roi.shape
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def cached(self, key, compute):
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._cache:
+                self._cache[key] = compute()
+            return self._cache[key]
+
+    @property
+    def gray(self):
+        return self.cached('gray', lambda: cv2.cvtColor(self.roi, cv2.COLOR_BGR2GRAY) if len(self.roi.shape) > 2 else self.roi)
+
+    def blur(self, ksize, sigma=2):
+        return self.cached(('blur', ksize, sigma), lambda: cv2.GaussianBlur(self.gray, (ksize, ksize), sigma))
+
+    def adaptive(self, ksize):
+        return self.cached(('adaptive', ksize), lambda: cv2.adaptiveThreshold(self.blur(ksize), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
+                                                                              cv2.THRESH_BINARY_INV, 11, 2))
+
+    @property
+    def binary(self):
+        def compute():
+            _, binary = cv2.threshold(self.blur(self.BINARY_BLUR), 127, 255, cv2.THRESH_BINARY_INV)
+            return cv2.bitwise_or(binary, self.adaptive(self.BINARY_BLUR))
+        return self.cached('binary', compute)
+
+    @property
+    def integral(self):
+        """
+        Integral image of the filled pixels of the binary map
+        """
+        return self.cached('integral', lambda: cv2.integral((self.binary != 0).astype(np.uint8)))
+
+    def dog(self, s, ksize=11):
+        """
+        Difference of gaussians (sigma s * sqrt(2) minus s / sqrt(2)) of the blurred roi, normalized in 0-255
+        """
+        def compute():
+            gray = self.blur(ksize)
+            s1 = s / 1.4142 # stretto
+            im1 = cv2.GaussianBlur(gray, (round_up_to_odd(1 + 5 * s1), round_up_to_odd(1 + 5 * s1)), s1)
+            s2 = s * 1.4142 #largo
+            im2 = cv2.GaussianBlur(gray, (round_up_to_odd(1 + 5 * s2), round_up_to_odd(1 + 5 * s2)), s2)
+            response = im2.astype(float) - im1.astype(float)  #largo - stretto
+            return cv2.normalize(response, None, 0, 255, cv2.NORM_MINMAX, cv2.CV_8UC1)
+        return self.cached(('dog', s, ksize), compute)
+
 def line_intersect(pts1, pts2):
     m1 = pts1[1] - pts1[0]
     m1 = m1[1] / m1[0] 
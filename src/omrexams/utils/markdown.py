@@ -5,7 +5,7 @@ from mistletoe.base_renderer import BaseRenderer
 from mistletoe.html_renderer import HTMLRenderer
 from mistletoe.latex_renderer import LaTeXRenderer
 import random
-from . crypt import binary_encrypt
+from . crypt import binary_encrypt, compact_encrypt
 import re
 import logging
 import click
@@ -293,8 +293,12 @@ class QuestionRenderer(LaTeXRenderer):
                 if q['answers'][i]:
                     current += chr(ord('A') + i)
             solutions.append(current)
+        # the compact (version 2) qrcode payload encodes the solutions in qrcode alphanumeric mode
+        compact = self.parameters.get('qrcode_version', 1) == 2
         # encryption of the solution is the default option
-        if self.parameters.get('encrypt', True): 
+        if compact:
+            solutions = compact_encrypt(solutions, self.parameters['student_no'] if self.parameters.get('encrypt', True) else None)
+        elif self.parameters.get('encrypt', True): 
             solutions = f"{binary_encrypt(solutions, self.parameters['student_no'])}"
 #            solutions = vigenere_encrypt(','.join(solutions), self.parameters['student_no'])
         else:
@@ -306,6 +310,8 @@ class QuestionRenderer(LaTeXRenderer):
             options.append('sflabel')
         if self.parameters.get('dyslexia'):
             options.append('dyslexia')
+        if compact:
+            options.append('compactqr')
             
         doc = pylatex.Document('basic')
         doc.documentclass = pylatex.Command('documentclass',
@@ -0,0 +1,85 @@
+import numpy as np
+import cv2
+from . colors import WHITE, BLUE
+
+def plain(value):
+    """
+    Converts the arguments of the drawing operations to plain python values (tuples for the
+    points and the colors), so that they can be stored as json and passed to OpenCV again
+    """
+    if isinstance(value, Overlay):
+        return value
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(plain(v) for v in value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    return value
+
+def add_superimposed(image, mask, roi, p0, p1, method):
+    superimposed = cv2.bitwise_and(mask, roi)
+    prev_x = image.shape[1]
+    image = cv2.copyMakeBorder(image, 0, 0, 0, superimposed.shape[1], cv2.BORDER_CONSTANT, value=WHITE)
+    image[p0[1]:p1[1], prev_x:prev_x + superimposed.shape[1]] = superimposed
+    cv2.putText(image, method, (prev_x, p0[1]), cv2.FONT_HERSHEY_SIMPLEX, 1, BLUE, 3)
+    return image
+
+class Overlay:
+    """
+    The annotations of a page (or of its roi) recorded as data: each drawing operation is stored
+    with its arguments and the image is drawn only when rendering, possibly much later or never
+    """
+    def __init__(self, shape=None, operations=None):
+        # the shape of the (white) mask drawn when there is no image to render onto
+        self.shape = None if shape is None else tuple(shape[:2])
+        self.operations = operations if operations is not None else []
+
+    def circle(self, center, radius, color, thickness=1):
+        self.operations.append(('circle', plain((center, radius, color, thickness))))
+
+    def rectangle(self, pt1, pt2, color, thickness=1):
+        self.operations.append(('rectangle', plain((pt1, pt2, color, thickness))))
+
+    def putText(self, text, org, font, scale, color, thickness=1):
+        self.operations.append(('putText', plain((text, org, font, scale, color, thickness))))
+
+    def paste(self, overlay, top):
+        """
+        Draws another overlay (e.g., of a strip) on the rows of the mask from top on, the annotations
+        already drawn there (e.g., of the neighbouring rows) are kept
+        """
+        self.operations.append(('paste', (overlay, int(top))))
+
+    def superimpose(self, overlay, p0, p1, method):
+        """
+        Appends the mask of an overlay, superimposed to the roi, on the right of the page
+        """
+        self.operations.append(('superimpose', plain((overlay, p0, p1, method))))
+
+    def render(self, image=None):
+        if image is None:
+            image = np.ones((*self.shape, 3), np.uint8) * 255
+        for operation, args in self.operations:
+            if operation == 'paste':
+                overlay, top = args
+                overlay.render(image[top:top + overlay.shape[0]])
+            elif operation == 'superimpose':
+                overlay, p0, p1, method = args
+                # the roi is unchanged by the previous operations, which draw outside of it
+                roi = image[p0[1]:p1[1], p0[0]:p1[0]]
+                image = add_superimposed(image, overlay.render(), roi, p0, p1, method)
+            else:
+                getattr(cv2, operation)(image, *args)
+        return image
+
+    def to_data(self):
+        return { 'shape': self.shape,
+                 'operations': [(operation, [a.to_data() if isinstance(a, Overlay) else a for a in args])
+                                for operation, args in self.operations] }
+
+    @staticmethod
+    def from_data(data):
+        operations = [(operation, tuple(Overlay.from_data(a) if isinstance(a, dict) else plain(a) for a in args))
+                      for operation, args in data['operations']]
+        return Overlay(data['shape'], operations)
@@ -0,0 +1,189 @@
+import os
+import mmap
+import json
+import struct
+import numpy as np
+import cv2
+import logging
+from . import qrdecoder
+
+logger = logging.getLogger("omrexams")
+
+# name of the container file within the sorted directory
+CONTAINER_NAME = 'pages.omrp'
+# name of the sidecar index with the decoded qrcode metadata of the sorted pages
+METADATA_NAME = 'metadata.jsonl'
+
+# each record is a header followed by the key (utf-8) and the encoded page
+RECORD_MAGIC = b'OMRP'
+RECORD_HEADER = struct.Struct('<4sHBxIIQ') # magic, key length, codec, height, width, data length
+# the index (json) is appended after the records and located through the trailer
+INDEX_MAGIC = b'OMRI'
+TRAILER = struct.Struct('<4sQ') # magic, index offset
+
+CODECS = { 'png': 0, 'raw': 1 }
+
+class PageStore:
+    """
+    A single container file of grayscale pages, indexed by key (i.e., student_id-page).
+    Pages are either stored as fast (low compression) png or as raw memory-mappable
+    pixels, which can be read back without any decoding.
+    Records are appended one after another, so the index can always be rebuilt
+    by scanning the record headers (e.g., after an interrupted run).
+    """
+    def __init__(self, filename, codec='png'):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown page codec {codec}, should be one of {', '.join(CODECS)}")
+        self.filename = filename
+        self.codec = codec
+        self.index = None
+        self._file = None
+        self._mmap = None
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, CONTAINER_NAME))
+
+    @staticmethod
+    def open(directory, codec='png'):
+        """
+        Opens the container of the directory for appending further pages (possibly creating it),
+        the index of the pages already stored is kept in memory
+        """
+        filename = os.path.join(directory, CONTAINER_NAME)
+        if not os.path.exists(filename):
+            open(filename, 'wb').close()
+        store = PageStore(filename, codec)
+        store.index, end = store.scan()
+        # get rid of the index of the previous run, it will be written again when closing
+        with open(filename, 'r+b') as f:
+            f.truncate(end)
+        return store
+
+    def append(self, key, image, lock):
+        """
+        Appends a page to the container, the lock is shared among the writing processes.
+        It returns the offset of the page data within the container.
+        """
+        if len(image.shape) > 2:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if self.codec == 'png':
+            _, data = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+            data = data.tobytes()
+        else:
+            data = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+        key = key.encode('utf-8')
+        header = RECORD_HEADER.pack(RECORD_MAGIC, len(key), CODECS[self.codec], image.shape[0], image.shape[1], len(data))
+        if self._file is None:
+            # each writing process has its own file handle
+            self._file = open(self.filename, 'ab')
+        with lock:
+            self._file.write(header + key + data)
+            self._file.flush()
+            return self._file.tell() - len(data)
+
+    def close(self):
+        """
+        Writes the index at the end of the container
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index, end = self.scan()
+        with open(self.filename, 'r+b') as f:
+            f.truncate(end)
+            f.seek(end)
+            f.write(json.dumps(index).encode('utf-8'))
+            f.write(TRAILER.pack(INDEX_MAGIC, end))
+
+    def scan(self):
+        """
+        Rebuilds the index from the record headers, it returns the index and the end of the last record
+        """
+        index = {}
+        with open(self.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                f.seek(offset)
+                magic, key_length, codec, height, width, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                if magic != RECORD_MAGIC:
+                    break
+                start = offset + RECORD_HEADER.size + key_length
+                if start + length > size: # truncated record
+                    break
+                key = f.read(key_length).decode('utf-8')
+                # later records of the same page replace the previous ones
+                index[key] = (start, length, codec, height, width)
+                offset = start + length
+        return index, offset
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= TRAILER.size:
+                f.seek(size - TRAILER.size)
+                magic, offset = TRAILER.unpack(f.read(TRAILER.size))
+                if magic == INDEX_MAGIC:
+                    f.seek(offset)
+                    self.index = { k: tuple(v) for k, v in json.loads(f.read(size - TRAILER.size - offset)).items() }
+                    return
+        logger.warning(f"Index of {self.filename} not found, rebuilding it")
+        self.index, _ = self.scan()
+
+    def keys(self):
+        if self.index is None:
+            self.load()
+        return sorted(self.index.keys())
+
+    def read(self, key):
+        if self.index is None:
+            self.load()
+        if self._mmap is None:
+            with open(self.filename, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start, length, codec, height, width = self.index[key]
+        data = np.frombuffer(self._mmap, dtype=np.uint8, count=length, offset=start)
+        if codec == CODECS['raw']:
+            return data.reshape(height, width)
+        return cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+
+
+def page_stamp(directory, key, store=None):
+    """
+    Identifies the current content of a sorted page (i.e., its offset within the container or 
+    the size and modification time of its png file), it is used for detecting stale metadata
+    """
+    if store is not None:
+        if store.index is None:
+            store.load()
+        record = store.index.get(key)
+        return None if record is None else ['container', record[0]]
+    try:
+        stat = os.stat(os.path.join(directory, f"{key}.png"))
+    except FileNotFoundError:
+        return None
+    return ['file', stat.st_size, stat.st_mtime_ns]
+
+def append_metadata(directory, key, stamp, metadata, lock):
+    with lock:
+        with open(os.path.join(directory, METADATA_NAME), 'a') as f:
+            f.write(json.dumps({ 'key': key, 'stamp': stamp, 'metadata': qrdecoder.serialize(metadata) }) + "\n")
+
+def load_metadata(directory, store=None):
+    """
+    Reads the metadata of the sorted pages, only for those pages whose content has not changed since
+    """
+    filename = os.path.join(directory, METADATA_NAME)
+    entries = {}
+    if not os.path.exists(filename):
+        return entries
+    with open(filename) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError: # possibly a line truncated by an interrupted run
+                continue
+            entries[entry['key']] = entry
+    return { key: qrdecoder.deserialize(entry['metadata']) for key, entry in entries.items() 
+             if entry['stamp'] == page_stamp(directory, key, store) }
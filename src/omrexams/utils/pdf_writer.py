@@ -0,0 +1,119 @@
+import struct
+import logging
+
+logger = logging.getLogger("omrexams")
+
+# the catalog, the page tree and the outline root are written last, but their numbers are fixed
+CATALOG, PAGES, OUTLINES = 1, 2, 3
+
+# start of frame markers (baseline, progressive, etc.), they hold the size of the image
+SOF_MARKERS = { 0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF }
+COLOR_SPACES = { 1: '/DeviceGray', 3: '/DeviceRGB' }
+
+def jpeg_info(data):
+    """
+    Reads the width, the height and the number of components of a jpeg image from its header
+    """
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            raise ValueError("Corrupted jpeg image")
+        marker, length = data[offset + 1], struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if marker in SOF_MARKERS:
+            _, height, width, components = struct.unpack('>BHHB', data[offset + 4:offset + 10])
+            return width, height, components
+        offset += 2 + length
+    raise ValueError("Size of the jpeg image not found")
+
+def pdf_string(text):
+    """
+    Literal pdf string, as utf-16 (hex string) if not plain ascii
+    """
+    try:
+        text.encode('ascii')
+    except UnicodeEncodeError:
+        return '<FEFF' + text.encode('utf-16-be').hex().upper() + '>'
+    return '(' + text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') + ')'
+
+class StreamingPdfWriter:
+    """
+    Writes a pdf file made of one jpeg image per page, page after page: the jpeg data is embedded
+    as it is (DCTDecode) and only the object offsets, the pages and the outline items are kept in
+    memory, the page tree and the outline are written when closing.
+    """
+    def __init__(self, filename, resolution=72):
+        self.filename = filename
+        self.resolution = resolution
+        self.offsets = {}
+        self.pages = []
+        # title and page number of each outline item
+        self.outline = []
+        self._next = OUTLINES + 1
+        self._file = open(filename, 'wb')
+        # the binary comment tells that the file contains binary data
+        self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def reserve(self):
+        number = self._next
+        self._next += 1
+        return number
+
+    def write_object(self, number, content, stream=None):
+        self.offsets[number] = self._file.tell()
+        self._file.write(f"{number} 0 obj\n{content}\n".encode('latin-1'))
+        if stream is not None:
+            self._file.write(b'stream\n' + stream + b'\nendstream\n')
+        self._file.write(b'endobj\n')
+
+    def add_jpeg(self, jpeg, outline=None):
+        """
+        Appends a page with a jpeg image (a filename or its data), possibly starting an outline item
+        """
+        if isinstance(jpeg, str):
+            with open(jpeg, 'rb') as f:
+                jpeg = f.read()
+        width, height, components = jpeg_info(jpeg)
+        if components not in COLOR_SPACES:
+            raise ValueError(f"Unsupported jpeg image with {components} components")
+        page_width, page_height = (round(72.0 * s / self.resolution, 4) for s in (width, height))
+        image, content, page = self.reserve(), self.reserve(), self.reserve()
+        self.write_object(image, f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                                 f"/ColorSpace {COLOR_SPACES[components]} /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>", jpeg)
+        drawing = f"q {page_width} 0 0 {page_height} 0 0 cm /Im0 Do Q".encode('latin-1')
+        self.write_object(content, f"<< /Length {len(drawing)} >>", drawing)
+        self.write_object(page, f"<< /Type /Page /Parent {PAGES} 0 R /MediaBox [0 0 {page_width} {page_height}] "
+                                f"/Resources << /XObject << /Im0 {image} 0 R >> >> /Contents {content} 0 R >>")
+        if outline is not None:
+            self.outline.append((outline, page))
+        self.pages.append(page)
+        # the page is on disk, nothing but its number is kept
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        items = [self.reserve() for _ in self.outline]
+        for i, (number, (title, page)) in enumerate(zip(items, self.outline)):
+            links = (f"/Prev {items[i - 1]} 0 R " if i > 0 else "") + (f"/Next {items[i + 1]} 0 R " if i + 1 < len(items) else "")
+            self.write_object(number, f"<< /Title {pdf_string(title)} /Parent {OUTLINES} 0 R {links}/Dest [{page} 0 R /Fit] >>")
+        if items:
+            self.write_object(OUTLINES, f"<< /Type /Outlines /First {items[0]} 0 R /Last {items[-1]} 0 R /Count {len(items)} >>")
+        else:
+            self.write_object(OUTLINES, "<< /Type /Outlines /Count 0 >>")
+        self.write_object(PAGES, f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in self.pages)}] /Count {len(self.pages)} >>")
+        self.write_object(CATALOG, f"<< /Type /Catalog /Pages {PAGES} 0 R /Outlines {OUTLINES} 0 R"
+                                   f"{' /PageMode /UseOutlines' if items else ''} >>")
+        xref = self._file.tell()
+        self._file.write(f"xref\n0 {self._next}\n0000000000 65535 f \n".encode('latin-1'))
+        for number in range(1, self._next):
+            self._file.write(f"{self.offsets[number]:010d} 00000 n \n".encode('latin-1'))
+        self._file.write(f"trailer\n<< /Size {self._next} /Root {CATALOG} 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1'))
+        self._file.close()
+        self._file = None
+        logger.info(f"Written {len(self.pages)} pages to {self.filename}")
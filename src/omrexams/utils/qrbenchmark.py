@@ -0,0 +1,175 @@
+import re
+import json
+import time
+import platform
+import numpy as np
+import cv2
+from tabulate import tabulate
+from . import qrdecoder
+from . crypt import binary_encrypt, compact_encrypt
+import logging
+
+logger = logging.getLogger("omrexams")
+
+# page layout (in cm) of the qrcodes, as in the omrexam class
+PAGE_SIZE = (21.0, 29.7)
+QRCODE_MARGIN = 1.0
+QRCODE_SIZE = 2.5
+
+# degradations of the scanned pages, each one with the parameters benchmarked
+DEGRADATIONS = {
+    'none': [None],
+    'blur': [1.5, 3.0],            # gaussian sigma (pixels)
+    'noise': [15, 35],             # gaussian noise standard deviation
+    'jpeg': [30, 10],              # jpeg quality
+    'rotation': [1.5, 180],        # degrees
+    'contrast': [0.4, 0.15]        # fraction of the original contrast
+}
+
+# preprocessing stages applied before the search
+STAGES = {
+    'plain': lambda image: image,
+    'clahe': lambda image: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(image),
+    'enhanced': qrdecoder.prepare_image_for_decoding
+}
+
+def cm_to_pixels(length, resolution):
+    return int(round(length / 2.54 * resolution))
+
+def qrcode_image(text, size):
+    qrcode = cv2.QRCodeEncoder.create().encode(text)
+    return cv2.resize(qrcode, (size, size), interpolation=cv2.INTER_NEAREST)
+
+# versions of the qrcode payloads
+PAYLOAD_VERSIONS = [1, 2]
+
+def payloads(student_id, solutions, page, start, version=1):
+    """
+    Contents of the top left and bottom right qrcodes, as written by the omrexam class
+    """
+    # sizes are in pt, relative to the top left corner of the first qrcode
+    qrwidth, qrheight = (int((s - 2 * QRCODE_MARGIN) / 2.54 * 72) for s in PAGE_SIZE)
+    end = start + len(solutions) - 1
+    if version == 2:
+        top_left = f"2/{student_id}/{compact_encrypt(solutions, student_id)}"
+        bottom_right = f"2:40:150:520:780:{qrwidth}:{qrheight}:14.0:{page}:{start}:{end}"
+        assert re.search(qrdecoder.TOP_LEFT_V2_REGEX, top_left) and re.search(qrdecoder.BOTTOM_RIGHT_V2_REGEX, bottom_right)
+    else:
+        top_left = f"{student_id},{binary_encrypt(solutions, student_id)}"
+        bottom_right = f"(40,150)-(520,780)/({qrwidth},{qrheight})/14.0,{page},{start}-{end}"
+        assert re.search(qrdecoder.TOP_LEFT_REGEX, top_left) and re.search(qrdecoder.BOTTOM_RIGHT_REGEX, bottom_right)
+    return top_left, bottom_right
+
+def synthetic_page(student_id, solutions, page, rng, resolution=300, version=1):
+    """
+    Renders a page with the two qrcodes of an exam (with the real payload formats) and some clutter
+    in the question area, it returns the image together with the expected content
+    """
+    width, height = (cm_to_pixels(s, resolution) for s in PAGE_SIZE)
+    margin, size = cm_to_pixels(QRCODE_MARGIN, resolution), cm_to_pixels(QRCODE_SIZE, resolution)
+    image = np.full((height, width), 255, dtype=np.uint8)
+    top_left, bottom_right = payloads(student_id, solutions, page, int(rng.integers(1, 20)), version)
+    image[margin:margin + size, margin:margin + size] = qrcode_image(top_left, size)
+    image[height - margin - size:height - margin, width - margin - size:width - margin] = qrcode_image(bottom_right, size)
+    # text-like clutter and bubbles between the qrcodes
+    for y in range(margin + size + 60, height - margin - size - 60, 70):
+        x = margin + int(rng.integers(0, width // 3))
+        cv2.line(image, (x, y), (x + int(rng.integers(width // 6, width // 2)), y), 0, int(rng.integers(2, 6)))
+        cv2.circle(image, (width - 4 * margin, y), 20, 0, 2)
+    return image, { 'student_id': str(student_id), 'correct': [s.upper() for s in solutions], 'page': page }
+
+def degrade(image, degradation, level, rng):
+    if degradation == 'blur':
+        return cv2.GaussianBlur(image, (0, 0), level)
+    if degradation == 'noise':
+        return np.clip(image + rng.normal(0, level, image.shape), 0, 255).astype(np.uint8)
+    if degradation == 'jpeg':
+        _, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, level])
+        return cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+    if degradation == 'rotation':
+        if level == 180:
+            return cv2.rotate(image, cv2.ROTATE_180)
+        rows, cols = image.shape
+        rotation = cv2.getRotationMatrix2D((cols / 2, rows / 2), level, 1.0)
+        return cv2.warpAffine(image, rotation, (cols, rows), borderValue=255)
+    if degradation == 'contrast':
+        return (255 - (255 - image.astype(np.float32)) * level).astype(np.uint8)
+    return image
+
+def attempt(decoder, image, expected, registry=None):
+    """
+    Decodes a page, possibly with its own registry of the libraries in place of the global one
+    """
+    saved = qrdecoder.backends
+    if registry is not None:
+        qrdecoder.backends = registry
+    start = time.perf_counter()
+    try:
+        metadata = decoder(image)
+        success = metadata is not None and all(metadata[k] == v for k, v in expected.items())
+    except qrdecoder.DECODING_ERRORS as e:
+        logger.debug(str(e))
+        success = False
+    finally:
+        qrdecoder.backends = saved
+    return success, time.perf_counter() - start
+
+def run(pages=5, resolution=300, seed=0):
+    """
+    Measures the decoding of synthetic pages for each library, preprocessing stage and degradation,
+    as well as the full (and fast) decoding cascade; it returns the list of measures
+    """
+    rng = np.random.default_rng(seed)
+    decoders = { (library, stage): (lambda image, search=qrdecoder.SEARCHES[library], prepare=STAGES[stage]:
+                                        qrdecoder.decode_qrcodes(prepare(image), search))
+                 for library in qrdecoder.PREFERRED_LIBRARIES if library in qrdecoder.available_libraries
+                 for stage in STAGES }
+    decoders[('cascade', 'fast')] = lambda image: qrdecoder.decode(image, fast=True)
+    decoders[('cascade', 'all')] = qrdecoder.decode
+    measures = { key: {} for key in decoders }
+    # the cascade reorders the libraries by their statistics, therefore each measured configuration
+    # starts from a fresh registry, neither affected by the others nor affecting the global one
+    registries = {}
+    for degradation, levels in DEGRADATIONS.items():
+        for level in levels:
+            for page in range(pages):
+                solutions = [''.join(sorted(set(rng.choice(list('abcd'), rng.integers(0, 3))))) for _ in range(10)]
+                student_id, page_seed = int(rng.integers(10000, 99999)), int(rng.integers(2 ** 32))
+                for version in PAYLOAD_VERSIONS:
+                    # same clutter and degradation for each payload version
+                    page_rng = np.random.default_rng(page_seed)
+                    image, expected = synthetic_page(student_id, solutions, page + 1, page_rng, resolution, version)
+                    image = degrade(image, degradation, level, page_rng)
+                    for key, decoder in decoders.items():
+                        registry = registries.setdefault((key, version, degradation, level), qrdecoder.Backends()) if key[0] == 'cascade' else None
+                        measures[key].setdefault((version, degradation, level), []).append(attempt(decoder, image, expected, registry))
+    results = []
+    for (library, stage), degradations in measures.items():
+        for (version, degradation, level), outcomes in degradations.items():
+            successes = [s for s, _ in outcomes]
+            latencies = 1000 * np.array([t for _, t in outcomes])
+            results.append({
+                'library': library, 'stage': stage, 'payload': version, 'degradation': degradation, 'level': level,
+                'pages': len(outcomes), 'success_rate': float(np.mean(successes)),
+                'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)),
+                'p99': float(np.percentile(latencies, 99))
+            })
+    return results
+
+def save(results, filename, **parameters):
+    from .. import __version__
+    with open(filename, 'w') as f:
+        json.dump({
+            'version': __version__,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'platform': platform.platform(),
+            'opencv': cv2.__version__,
+            'libraries': qrdecoder.available_libraries,
+            'parameters': parameters,
+            'results': results
+        }, f, indent=2)
+
+def table(results):
+    rows = [[r['library'], r['stage'], r['payload'], r['degradation'], r['level'], f"{r['success_rate']:.0%}",
+             f"{r['p50']:.1f}", f"{r['p90']:.1f}", f"{r['p99']:.1f}"] for r in results]
+    return tabulate(rows, headers=["Library", "Stage", "Payload", "Degradation", "Level", "Success", "p50 (ms)", "p90 (ms)", "p99 (ms)"], tablefmt="simple")
@@ -1,41 +1,148 @@
 import re
+import multiprocessing as mp
 import numpy as np
 import cv2
-from . crypt import binary_decrypt
+from . crypt import binary_decrypt, compact_decrypt
 from . colors import *
 from . image_utils import order_points
 from ctypes.util import find_library
 import logging
 import click
+import time
+from tabulate import tabulate
 
 logger = logging.getLogger("omrexams")
 
 
 TOP_LEFT_REGEX = r'^(?P<id>[\d-]+),(?P<sequence>.+)$'
 BOTTOM_RIGHT_REGEX = r'^\((?P<x0>\d+),\s*(?P<y0>\d+)\)-\((?P<x1>\d+),\s*(?P<y1>\d+)\)/\((?P<qrwidth>\d+),\s*(?P<qrheight>\d+)\)/(?P<bsize>\d+(?:\.\d+)?),\s*(?P<page>\d+)(?:,(?P<start>\d+)-(?P<end>\d+))?$'
+# compact (version 2) payloads, restricted to the qrcode alphanumeric characters for smaller qrcodes
+TOP_LEFT_V2_REGEX = r'^2/(?P<id>[\d-]+)/(?P<sequence>[EP][A-Z2-7]*)$'
+BOTTOM_RIGHT_V2_REGEX = r'^2:(?P<x0>\d+):(?P<y0>\d+):(?P<x1>\d+):(?P<y1>\d+):(?P<qrwidth>\d+):(?P<qrheight>\d+):(?P<bsize>\d+(?:\.\d+)?):(?P<page>\d+):(?P<start>\d+):(?P<end>\d+)$'
 
 available_libraries = ['openCV']
 try:
     import zxingcpp
     available_libraries.append('zxingcpp')
-except: 
+except ImportError: 
     pass
 try:
     from pyzbar import pyzbar
     if find_library('zbar'):
         available_libraries.append('pyzbar')
-except:
+except ImportError:
     pass
+# libraries in order of performance, the first available one is used by the fast decoding
+PREFERRED_LIBRARIES = ['zxingcpp', 'pyzbar', 'openCV']
+# fraction of the page (width, height) searched for the qrcode at each corner
+CORNER_REGION = (0.3, 0.2)
+# attempts needed before the success rate of a library is taken into account for its order
+MIN_ATTEMPTS = 10
+# errors raised by the libraries (or by the content checks) when a page cannot be decoded
+DECODING_ERRORS = (RuntimeError, ValueError, cv2.error)
+
+class Backends:
+    """
+    The decoding libraries available in the current process, each one with a single (reused) 
+    detector instance and the statistics of its attempts (number, successes and time).
+    The libraries that keep failing on the current batch of pages are moved at the end of the cascade.
+    """
+    def __init__(self):
+        self.statistics = np.zeros((len(PREFERRED_LIBRARIES), 3))
+        # statistics not yet collected by the main process
+        self.pending = np.zeros((len(PREFERRED_LIBRARIES), 3))
+        self._opencv_detector = None
+
+    def opencv_detector(self):
+        if self._opencv_detector is None:
+            self._opencv_detector = cv2.QRCodeDetector()
+        return self._opencv_detector
+
+    def success_rate(self, library):
+        attempts, successes, _ = self.statistics[PREFERRED_LIBRARIES.index(library)]
+        return successes / attempts if attempts >= MIN_ATTEMPTS else 1.0
+
+    def order(self):
+        # the sort is stable, therefore libraries with the same success rate keep the order of performance
+        return sorted((library for library in PREFERRED_LIBRARIES if library in available_libraries), 
+                      key=lambda library: -self.success_rate(library))
+
+    def record(self, library, success, seconds):
+        i = PREFERRED_LIBRARIES.index(library)
+        self.statistics[i] += (1, success, seconds)
+        self.pending[i] += (1, success, seconds)
+
+    def collect(self, shared):
+        """
+        Adds the pending statistics to the shared array of the main process
+        """
+        with shared.get_lock():
+            shared[:] = (np.frombuffer(shared.get_obj()) + self.pending.ravel()).tolist()
+        self.pending[:] = 0
+
+backends = Backends()
+
+def shared_statistics(lock):
+    return mp.Array('d', 3 * len(PREFERRED_LIBRARIES), lock=lock)
+
+def statistics_table(shared):
+    """
+    Formats the collected statistics of the libraries, it returns None if no page has been decoded
+    """
+    statistics = np.frombuffer(shared.get_obj()).reshape(-1, 3)
+    if not statistics[:, 0].any():
+        return None
+    table = [[library, int(attempts), int(successes), f"{successes / attempts:.1%}", f"{1000 * seconds / attempts:.1f}"]
+             for library, (attempts, successes, seconds) in zip(PREFERRED_LIBRARIES, statistics) if attempts > 0]
+    return tabulate(table, headers=["Library", "Attempts", "Decoded", "Success rate", "Mean time (ms)"], tablefmt="simple")
+
+def is_blank(image):
+    if len(image.shape) > 2:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _retval, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return cv2.countNonZero(binary) >= (image.shape[0] * image.shape[1]) * 0.99
+
+def rescale(metadata, factor):
+    """
+    Maps the image coordinates of the decoded metadata to an image scaled by the given factor
+    """
+    metadata = dict(metadata)
+    for k in ('top_left', 'bottom_right', 'top_left_rect', 'bottom_right_rect'):
+        v = np.asarray(metadata[k])
+        metadata[k] = np.round(v * factor).astype(v.dtype)
+    metadata['scaling'] = metadata['scaling'] * factor
+    return metadata
+
+# array valued fields of the metadata, with their type
+ARRAY_FIELDS = { 'p0': int, 'p1': int, 'top_left': int, 'bottom_right': int, 
+                 'top_left_rect': int, 'bottom_right_rect': int, 'scaling': float }
+
+def serialize(metadata):
+    """
+    Converts the decoded metadata into plain (json serializable) values
+    """
+    return { k: np.asarray(v).tolist() if k in ARRAY_FIELDS else v for k, v in metadata.items() }
+
+def deserialize(data):
+    metadata = { k: np.array(v, dtype=ARRAY_FIELDS[k]) if k in ARRAY_FIELDS else v for k, v in data.items() }
+    metadata['range'] = tuple(metadata['range'])
+    return metadata
+
+def is_top_left(data):
+    return re.search(TOP_LEFT_V2_REGEX, data) or re.search(TOP_LEFT_REGEX, data)
+
+def is_bottom_right(data):
+    return re.search(BOTTOM_RIGHT_V2_REGEX, data) or re.search(BOTTOM_RIGHT_REGEX, data)
 
 def check_rotation(data):
-    if re.search(TOP_LEFT_REGEX, data[0]) and re.search(BOTTOM_RIGHT_REGEX, data[1]):
+    if is_top_left(data[0]) and is_bottom_right(data[1]):
         return False
-    if re.search(BOTTOM_RIGHT_REGEX, data[0]) and re.search(TOP_LEFT_REGEX, data[1]):
+    if is_bottom_right(data[0]) and is_top_left(data[1]):
         return True
     raise RuntimeError(f"Not meaningful qrcode content {data}")
 
 def decode_bottom_right(data):
-        m = re.search(BOTTOM_RIGHT_REGEX, data)
+        m = is_bottom_right(data)
         if not m:
             return None
             
@@ -54,6 +161,12 @@ def decode_bottom_right(data):
                }
 
 def decode_top_left(data):
+    m = re.search(TOP_LEFT_V2_REGEX, data)
+    if m:
+        return { 
+            'student_id': m.group('id'),
+            'correct': list(c.upper() for c in compact_decrypt(m.group('sequence'), m.group('id')))
+        }
     m = re.search(TOP_LEFT_REGEX, data)
     if not m:
         return None
@@ -74,7 +187,7 @@ def decode_top_left(data):
 
 
 # Preprocess the image to improve QR code detection
-# Not used yet, but could be useful in some cases, to be cheked
+# Used by the escalated decoding of the pages the plain decoding failed on
 def prepare_image_for_decoding(image):
     if len(image.shape) > 2:
         g = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -107,244 +220,182 @@ def prepare_image_for_decoding(image):
     return bw
 
 
-def decode(image, highlight=False, offset=5):   
-    def search_qrcodes_opencv(image):
-        ret_code, decoded_text, qrcodes, _ = cv2.QRCodeDetector().detectAndDecodeMulti(image)     
-        # Try to detect (and skip) blank images
-        if not ret_code or qrcodes.shape[0] < 2:
-            _retval, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-            if cv2.countNonZero(binary) >= (image.shape[0] * image.shape[1]) * 0.99: # Blank image
-                return None, None        
-        # adaptively change threshold to detect the qrcode
-        t = 255
-        while not np.isclose(t, 0.0) and (not ret_code or qrcodes.shape[0] < 2 or not all(d for d in decoded_text)):
-            t = int(t / 1.61803398875)
-            _, binary = cv2.threshold(image, 255 - t, 255, cv2.THRESH_BINARY)
-            ret_code, decoded_text, qrcodes, _ = cv2.QRCodeDetector().detectAndDecodeMulti(binary)
-
+def rotate_points(points, shape):
+    """
+    Maps the (corner) points of an image to the same image rotated by 180 degrees
+    """
+    height, width = shape[:2]
+    return np.array([width, height], dtype=points.dtype) - points
+
+def search_qrcodes_zxing(image, expected):
+    return [(qrcode.text, np.array([[p.x, p.y] for p in (qrcode.position.top_left, qrcode.position.top_right, 
+                                                         qrcode.position.bottom_right, qrcode.position.bottom_left)], dtype=np.float32))
+            for qrcode in zxingcpp.read_barcodes(image, formats=zxingcpp.BarcodeFormat.QRCode)]
+
+def search_qrcodes_pyzbar(image, expected):
+    def search(image):
+        return [(qrcode.data.decode('ascii'), np.array([[p.x, p.y] for p in qrcode.polygon], dtype=np.float32)) 
+                for qrcode in pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.QRCODE])]
+    qrcodes = search(image)
+    # adaptively change threshold to detect the qrcode
+    t = 255
+    while t > 0 and len(qrcodes) < expected:
+        t = int(t / 1.61803398875)
+        _retval, binary = cv2.threshold(image, 255 - t, 255, cv2.THRESH_BINARY)
+        qrcodes = search(binary)
+    return qrcodes
+
+def search_qrcodes_opencv(image, expected):
+    def search(image):
+        ret_code, decoded_text, qrcodes, _ = backends.opencv_detector().detectAndDecodeMulti(image)
+        if not ret_code or qrcodes is None:
+            return [], False
+        return [(text, qrcode) for text, qrcode in zip(decoded_text, qrcodes)], all(decoded_text)
+    qrcodes, decoded = search(image)
+    # Try to detect (and skip) blank images
+    if len(qrcodes) < expected and is_blank(image):
+        return None
+    # adaptively change threshold to detect the qrcode
+    t = 255
+    while not np.isclose(t, 0.0) and (len(qrcodes) < expected or not decoded):
+        t = int(t / 1.61803398875)
+        _, binary = cv2.threshold(image, 255 - t, 255, cv2.THRESH_BINARY)
+        qrcodes, decoded = search(binary)
+    return [(text, qrcode) for text, qrcode in qrcodes if text]
+
+SEARCHES = { 'zxingcpp': search_qrcodes_zxing, 'pyzbar': search_qrcodes_pyzbar, 'openCV': search_qrcodes_opencv }
+
+def search_corners(image, search):
+    """
+    Searches a single qrcode in each corner region, it returns None if they are not found.
+    The same regions hold the two qrcodes also when the page is upside down.
+    """
+    height, width = image.shape[:2]
+    corner_width, corner_height = int(width * CORNER_REGION[0]), int(height * CORNER_REGION[1])
+    qrcodes = []
+    for x, y in ((0, 0), (width - corner_width, height - corner_height)):
+        found = search(np.ascontiguousarray(image[y:y + corner_height, x:x + corner_width]), 1)
+        if not found or len(found) != 1:
+            return None
+        text, qrcode = found[0]
+        # map the qrcode back to the page coordinates
+        qrcodes.append((text, qrcode + np.array([x, y], dtype=qrcode.dtype)))
+    return qrcodes
+
+def search_page(image, search):
+    qrcodes = search(image, 2)
+    if qrcodes is None: # Empty page detected
+        return None
+    if len(qrcodes) < 2:
+        raise RuntimeError(f"Each page should have at least two qrcodes, found {len(qrcodes)}")
+    if len(qrcodes) == 4:
+        click.secho("Found 4 qrcodes in page, probably it is an A3 printed exam, therefore you should use --paper a3 in sorting", color="red")
+        raise RuntimeError("Found 4 qrcodes, probably you should use --paper a3 in sorting")
+    if len(qrcodes) > 2:
+        raise RuntimeError(f"Found more than two qrcodes {len(qrcodes)}")
+    # the top left qrcode comes first
+    qrcodes.sort(key=lambda qrcode: tuple(qrcode[1][0]))
+    return qrcodes
+
+def qrcodes_metadata(image, qrcodes):
+    """
+    Extracts the metadata of a page from its two qrcodes (the top left one first)
+    """
+    # decide for rotation
+    rotated = check_rotation([text for text, _ in qrcodes])
+    if rotated:
+        # the qrcodes are mapped to the upright page (rotated by the caller) instead of being searched again
+        qrcodes = [(text, rotate_points(qrcode, image.shape)) for text, qrcode in reversed(qrcodes)]
+
+    # extract information from the qrcode
+    top_left_decode = decode_top_left(qrcodes[0][0])
+    bottom_right_decode = decode_bottom_right(qrcodes[1][0])
+
+    t = order_points(np.concatenate([qrcode for _, qrcode in qrcodes]))
+    tl = t[0].astype('int')
+    br = t[2].astype('int')
+
+    metadata = { 
+        **top_left_decode,
+        **bottom_right_decode,
+        'top_left': tl,
+        'bottom_right': br,
+        'top_left_rect': order_points(qrcodes[0][1].astype('int')),
+        'bottom_right_rect': order_points(qrcodes[1][1].astype('int')),
+        'rotated': rotated
+    }
+    s = image[tl[1]:br[1], tl[0]:br[0]].shape
+    metadata['scaling'] = np.diag([s[1] / metadata['qrwidth'], s[0] / metadata['qrheight']])
+    return metadata
+
+def decode_qrcodes(image, search, highlight=False, offset=5, corners=True):
+    metadata = None
+    qrcodes = search_corners(image, search) if corners else None
+    if qrcodes is not None:
+        # the qrcodes in the corners are checked before drawing anything, the whole page is searched otherwise
+        try:
+            metadata = qrcodes_metadata(image, qrcodes)
+        except DECODING_ERRORS as e:
+            logger.debug(f"Qrcodes found in the corners not usable: {e}")
+        else:
+            scaling = metadata['scaling']
+            # qrcodes of different pages (e.g., an unsplit A3 sheet) in the corners give an anisotropic scaling
+            if not np.isclose(scaling[0, 0], scaling[1, 1], rtol=0.1):
+                metadata = None
+    if metadata is None:
+        qrcodes = search_page(image, search)
         if qrcodes is None:
-            raise RuntimeError(f"Cannot find qrcodes in page")
-
-        if qrcodes.shape[0] < 2:
-            raise RuntimeError(f"Each page should have at least two qrcodes, found {len(qrcodes)}")
-        if qrcodes.shape[0] == 4:
-            click.secho("Found 4 qrcodes in page, probably it is an A3 printed exam, therefore you should use --paper a3 in sorting", color="red")
-            raise RuntimeError("Found 4 qrcodes, probably you should use --paper a3 in sorting")
-        if qrcodes.shape[0] > 2:
-            raise RuntimeError(f"Found more than two qrcodes {len(qrcodes)}")     
-            
-        # TODO: maybe np.lexsort could be used
-        x = qrcodes[0, 0, 0], qrcodes[1, 0, 0]
-        y = qrcodes[0, 0, 1], qrcodes[1, 0, 1]
-        if x[0] > x[1] or (x[0] == x[1] and y[0] > y[1]):
-            qrcodes[[0, 1]] = qrcodes[[1, 0]]
-            decoded_text = tuple(reversed(decoded_text))
-
-        return decoded_text, qrcodes
-
-    def opencv_decode(image, highlight=False, offset=5):
-        if len(image.shape) > 2:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) 
-        
-        decoded_text, qrcodes = search_qrcodes_opencv(image)
-
-        if decoded_text is None and qrcodes is None:
-            # Empty page detected
             return None
-        
-        # decide for rotation
-        rotated = check_rotation(decoded_text)
-        if rotated:
-            image = cv2.rotate(image, cv2.ROTATE_180)
-            decoded_text, qrcodes = search_qrcodes_opencv(image)
-
-        # extract information from the qrcode    
-        top_left_decode = decode_top_left(decoded_text[0])
-        bottom_right_decode = decode_bottom_right(decoded_text[1])                     
-        
-        t = order_points(np.array([q for qrcode in qrcodes for q in qrcode]))
-        tl = t[0].astype('int')
-        br = t[2].astype('int')
-
-        if highlight:
-            for qrcode in qrcodes:
-                # extract the bounding box location of the qrcode and draw a green 
-                # frame around them
-                t = order_points(qrcode.astype('int'))
-                # currently assumes that the image has the right orientation 
-                # if this is not the case, the qrcode.polygon can be inspected
-                # and possibly used for rotation
-                cv2.rectangle(image, t[0] - offset, t[2] + offset, GREEN, 3)
-
-        metadata = { 
-            **top_left_decode,
-            **bottom_right_decode,
-            'top_left': tl,
-            'bottom_right': br,
-            'top_left_rect': order_points(qrcodes[0].astype('int')),
-            'bottom_right_rect': order_points(qrcodes[1].astype('int')),
-            'rotated': rotated
-        }
-        s = image[tl[1]:br[1], tl[0]:br[0]].shape
-        scaling = np.diag([s[1] / metadata['qrwidth'], s[0] / metadata['qrheight']])
-        metadata['scaling'] = scaling
-        if metadata['range'][0] is not None and metadata['range'][1] is not None:
-            metadata['page_correction'] = metadata['correct'][metadata['range'][0] - 1:metadata['range'][1]]
+        metadata = qrcodes_metadata(image, qrcodes)
 
-        return metadata
-    
-    def search_qrcodes_pyzbar(image):
-        qrcodes = pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.QRCODE])
-        # Try to detect (and skip) blank images
-        if len(qrcodes) < 2:
-            _retval, binary = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-            if cv2.countNonZero(binary) >= (image.shape[0] * image.shape[1]) * 0.99: # Blank image
-                return None
-        # adaptively change threshold to detect the qrcode
-        t = 255
-        while t > 0 and len(qrcodes) < 2:
-            t = int(t / 1.61803398875)
-            _retval, binary = cv2.threshold(image, 255 - t, 255, cv2.THRESH_BINARY)
-            qrcodes = pyzbar.decode(binary, symbols=[pyzbar.ZBarSymbol.QRCODE])
-
-        if len(qrcodes) < 2:
-            raise RuntimeError(f"Each page should have at least two qrcodes, found {len(qrcodes)}")
-        if len(qrcodes) == 4:
-            click.secho("Found 4 qrcodes in page, probably it is an A3 printed exam, therefore you should use --paper a3 in sorting", color="red")
-            raise RuntimeError("Found 4 qrcodes, probably you should use --paper a3 in sorting")
-        if len(qrcodes) > 2:
-            raise RuntimeError(f"Found more than two qrcodes {qrcodes}")
-        qrcodes.sort(key=lambda b: b.rect[0])
-
-        return qrcodes
-
-    def pyzbar_decode(image, highlight=False, offset=5):                        
-        if len(image.shape) > 2:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)                 
-
-        qrcodes = search_qrcodes_pyzbar(image)
-        if len(qrcodes) < 2:
-            raise RuntimeError(f"Each page should have at least two qrcodes, found {len(qrcodes)}")
-        if len(qrcodes) == 4:
-            click.secho("Found 4 qrcodes in page, probably it is an A3 printed exam, therefore you should use --paper a3 in sorting", color="red")
-            raise RuntimeError("Found 4 qrcodes, probably you should use --paper a3 in sorting")
-        if len(qrcodes) > 2:
-            raise RuntimeError(f"Found more than two qrcodes {qrcodes}")
-      
-        rotated = check_rotation(list(map(lambda x: x.data.decode('ascii'), qrcodes)))
-        if rotated:
-            image = cv2.rotate(image, cv2.ROTATE_180)
-            qrcodes = search_qrcodes_pyzbar(image)
-
-        # extract information from the qrcode
-        top_left_decode = decode_top_left(qrcodes[0].data.decode('ascii'))
-        bottom_right_decode = decode_bottom_right(qrcodes[1].data.decode('ascii'))           
-
-        tl = np.array(qrcodes[0].rect[:2])
-        br = np.array(qrcodes[1].rect[:2]) + np.array(qrcodes[1].rect[2:])
-
-        if highlight:
-            for qrcode in qrcodes:
-                # extract the bounding box location of the qrcode and draw a green 
-                # frame around them
-                (x, y, w, h) = qrcode.rect
-                cv2.rectangle(image, (int(x - offset), int(y - offset)), (int(x + w + offset), int(y + h + offset)), GREEN, 3)
-
-        metadata = { 
-            **top_left_decode,
-            **bottom_right_decode,
-            'top_left': tl,
-            'bottom_right': br,
-            'top_left_rect': order_points(np.array(list(map(lambda p: np.array([p.x, p.y]), qrcodes[0].polygon)))),
-            'bottom_right_rect': order_points(np.array(list(map(lambda p: np.array([p.x, p.y]), qrcodes[1].polygon)))),
-            'rotated': rotated
-        }
-        s = image[tl[1]:br[1], tl[0]:br[0]].shape
-        scaling = np.diag([s[1] / metadata['qrwidth'], s[0] / metadata['qrheight']])
-        metadata['scaling'] = scaling
-        if metadata['range'][0] is not None and metadata['range'][1] is not None:
-            metadata['page_correction'] = metadata['correct'][metadata['range'][0] - 1:metadata['range'][1]]
-
-        return metadata            
-    
-    def search_qrcodes_zxing(image, highlight=False, offset=5):
-        return zxingcpp.read_barcodes(image)
-
-    def zxing_decode(image, highlight=False, offset=5):
-        if len(image.shape) > 2:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)                 
-
-        qrcodes = search_qrcodes_zxing(image)
-        if len(qrcodes) < 2:
-            raise RuntimeError(f"Each page should have at least two qrcodes, found {len(qrcodes)}")
-        if len(qrcodes) == 4:
-            click.secho("Found 4 qrcodes in page, probably it is an A3 printed exam, therefore you should use --paper a3 in sorting", color="red")
-            raise RuntimeError("Found 4 qrcodes, probably you should use --paper a3 in sorting")
-        if len(qrcodes) > 2:
-            raise RuntimeError(f"Found more than two qrcodes {qrcodes}")
-      
-        rotated = check_rotation(list(map(lambda x: x.text, qrcodes)))
-        if rotated:
-            image = cv2.rotate(image, cv2.ROTATE_180)
-            qrcodes = search_qrcodes_zxing(image)
-
-        # extract information from the qrcode
-        top_left_decode = decode_top_left(qrcodes[0].text)
-        bottom_right_decode = decode_bottom_right(qrcodes[1].text)    
-
-        tl = np.array([qrcodes[0].position.top_left.x, qrcodes[0].position.top_left.y])
-        br = np.array([qrcodes[1].position.bottom_right.x, qrcodes[1].position.bottom_right.y])
-
-        if highlight:
-            for qrcode in qrcodes:
-                # extract the bounding box location of the qrcode and draw a green 
-                # frame around them
-                (x, y, w, h) = qrcode.rect
-                cv2.rectangle(image, (int(x - offset), int(y - offset)), (int(x + w + offset), int(y + h + offset)), GREEN, 3)
-
-        metadata = { 
-            **top_left_decode,
-            **bottom_right_decode,
-            'top_left': tl,
-            'bottom_right': br,
-            'top_left_rect': np.array([[qrcodes[0].position.top_left.x, qrcodes[0].position.top_left.y], [qrcodes[0].position.top_right.x, qrcodes[0].position.top_right.y], [qrcodes[0].position.bottom_left.x, qrcodes[0].position.bottom_left.y], [qrcodes[0].position.bottom_right.x, qrcodes[0].position.bottom_right.y]]),
-            'bottom_right_rect': np.array([[qrcodes[1].position.top_left.x, qrcodes[1].position.top_left.y], [qrcodes[1].position.top_right.x, qrcodes[1].position.top_right.y], [qrcodes[1].position.bottom_left.x, qrcodes[1].position.bottom_left.y], [qrcodes[1].position.bottom_right.x, qrcodes[1].position.bottom_right.y]]),
-            'rotated': rotated
-        }
-        s = image[tl[1]:br[1], tl[0]:br[0]].shape
-        scaling = np.diag([s[1] / metadata['qrwidth'], s[0] / metadata['qrheight']])
-        metadata['scaling'] = scaling
-        if metadata['range'][0] is not None and metadata['range'][1] is not None:
-            metadata['page_correction'] = metadata['correct'][metadata['range'][0] - 1:metadata['range'][1]]
+    if highlight:
+        for _, qrcode in qrcodes:
+            # extract the bounding box location of the qrcode and draw a green 
+            # frame around them
+            t = order_points(qrcode.astype('int'))
+            cv2.rectangle(image, t[0] - offset, t[2] + offset, GREEN, 3)
 
-        return metadata     
+    if metadata['range'][0] is not None and metadata['range'][1] is not None:
+        metadata['page_correction'] = metadata['correct'][metadata['range'][0] - 1:metadata['range'][1]]
 
-    # Go in order of performance
-    if 'zxingcpp' in available_libraries:
-        try:
-            return zxing_decode(image, highlight, offset)
-        except:
-            pass
-    if 'pyzbar' in available_libraries:
+    return metadata
+
+def decode(image, highlight=False, offset=5, fast=False):   
+    """
+    Decodes the qrcodes of a page going through all the available libraries, it returns None for blank pages.
+    A fast decoding just tries the fastest library and raises an exception if the qrcodes are not found.
+    """
+    if len(image.shape) > 2:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Go in order of performance (possibly adapted to the current batch)
+    libraries = backends.order()
+    if fast:
+        libraries = libraries[:1]
+    error = None
+    failures = []
+    for library in libraries:
+        start = time.perf_counter()
         try:
-            return pyzbar_decode(image, highlight, offset)
-        except:
-            pass
-    # FALLBACK to opencv
-    assert 'openCV' in available_libraries, "OpenCV should be always available"
-    try:
-        return opencv_decode(image, highlight, offset)
-    except:
-        pass
+            metadata = decode_qrcodes(image, SEARCHES[library], highlight, offset)
+        except DECODING_ERRORS as e:
+            logger.debug(f"Decoding with {library} failed: {e}")
+            failures.append((library, time.perf_counter() - start))
+            error = e
+            continue
+        # failures on blank pages do not count against the libraries
+        if metadata is not None:
+            backends.record(library, True, time.perf_counter() - start)
+            for failed, seconds in failures:
+                backends.record(failed, False, seconds)
+        return metadata
+    if fast and is_blank(image):
+        return None
+    for failed, seconds in failures:
+        backends.record(failed, False, seconds)
+    if fast:
+        raise error
     # FALLBACK
-    if len(image.shape) > 2:
-        gray_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    else:
-        gray_img = image
+    assert 'openCV' in available_libraries, "OpenCV should be always available"
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    clahe_image = clahe.apply(gray_img)
-    return opencv_decode(clahe_image, highlight, offset)
-
-
-        
-
+    clahe_image = clahe.apply(image)
+    return decode_qrcodes(clahe_image, search_qrcodes_opencv, highlight, offset)
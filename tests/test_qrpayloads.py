@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from omrexams.utils import qrdecoder
+from omrexams.utils.crypt import binary_encrypt
+from omrexams.utils.qrbenchmark import payloads
+
+def random_exams(count, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        student_id = int(rng.integers(1, 999999))
+        solutions = [''.join(sorted(set(rng.choice(list('abcdefgh'), rng.integers(0, 4))))) for _ in range(rng.integers(1, 40))]
+        yield student_id, solutions, int(rng.integers(1, 10)), int(rng.integers(1, 50))
+
+def decode(student_id, solutions, page, start, version):
+    top_left, bottom_right = payloads(student_id, solutions, page, start, version)
+    return { **qrdecoder.decode_top_left(top_left), **qrdecoder.decode_bottom_right(bottom_right) }
+
+def v1_ambiguous(student_id, solutions):
+    """
+    The cases the version 1 payload does not decode back: the encrypted byte of the first question is
+    zero (it is dropped as a leading zero of the packed integer) or the base64 text is made only of the
+    letters of the answers (it is read as the solutions in clear)
+    """
+    first = 0
+    for c in solutions[0]:
+        first |= 1 << (ord(c) - ord('a'))
+    encrypted = binary_encrypt(solutions, student_id)
+    return first == ord(str(student_id)[0]) or all(c in 'ABCDEFGH,' for c in encrypted.upper())
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_compact_payload_roundtrip(seed):
+    for student_id, solutions, page, start in random_exams(1000, seed):
+        decoded = decode(student_id, solutions, page, start, 2)
+        assert decoded['student_id'] == str(student_id)
+        assert decoded['correct'] == [s.upper() for s in solutions]
+        assert decoded['page'] == page
+        assert decoded['range'] == (start, start + len(solutions) - 1)
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_payload_versions_equivalence(seed):
+    for student_id, solutions, page, start in random_exams(1000, seed):
+        v1, v2 = (decode(student_id, solutions, page, start, version) for version in (1, 2))
+        assert v1.keys() == v2.keys()
+        assert all(np.array_equal(v1[k], v2[k]) for k in v1 if k != 'correct')
+        assert (v1['correct'] == v2['correct']) != v1_ambiguous(student_id, solutions)